@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# DrfStore: A binary, column-oriented version of the DrForna *.drf format.
+#
+import os
+import json
+import argparse
+import numpy as np
+from array import array
+from itertools import islice
+
+from . import __version__
+from .trajectory import is_drt_file, drt_lines
+
+DRF_HEADER = "id time occupancy structure energy\n"
+
+_STORE_VERSION = 1
+_COLUMNS = {'id': np.int64,
+            'time': np.float64,
+            'occupancy': np.float64,
+            'energy': np.float64,
+            'structure': np.uint32}
+
+def _decimals(token):
+    """Number of digits after the decimal point of a numeric string."""
+    _, dot, frac = token.partition('.')
+    return len(frac) if dot else 0
+
+def _drf_lines(drffile):
+    """Yield the lines of a text *.drf file (without header). Trajectory
+    files (*.drt) are expanded onto their output times."""
+    if is_drt_file(drffile):
+        yield from drt_lines(drffile)
+        return
+    with open(drffile) as f:
+        assert next(f, DRF_HEADER) == DRF_HEADER
+        yield from f
+
+def is_drf_store(path):
+    """True if path is a directory written by :func:`drf_to_store`."""
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+class DrfStore:
+    """Memory-mapped reader for a binary *.drf store.
+
+    The store is a directory with one ``*.npy`` array per column (``id``,
+    ``time``, ``occupancy``, ``energy``) and a ``structure`` column that
+    indexes into a table of unique dot-bracket strings. The unique structures
+    are packed into one byte blob (``ss_blob``) with start offsets
+    (``ss_offsets``). All arrays are opened with ``mmap_mode = 'r'``, so
+    only the pages that are actually accessed are read from disk.
+
+    Args:
+      path (str): Path to the store directory.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as mf:
+            self.meta = json.load(mf)
+        if self.meta.get('version') != _STORE_VERSION:
+            raise ValueError(f'Unsupported drf store version in {path}.')
+        for col in _COLUMNS:
+            setattr(self, col, self._load(col))
+        self.ss_blob = self._load('ss_blob')
+        self.ss_offsets = self._load('ss_offsets')
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode = 'r')
+
+    @classmethod
+    def from_drf(cls, drffile, chunksize = 1 << 16):
+        """Parse a text *.drf file (or a *.drt trajectory) into an in-memory store.
+
+        Every unique structure is stored exactly once. The number of decimals
+        per numeric column and the alignment of IDs are recorded, such that
+        :meth:`to_drf` restores the text file at the original precision.
+
+        Args:
+          drffile (str): The *.drf input file.
+          chunksize (int, optional): Number of lines converted at once.
+        """
+        cols = {col: [] for col in _COLUMNS}
+        decimals = {'time': 0, 'occupancy': 0, 'energy': 0}
+        id_width = 0 # Only set if the input uses right-aligned IDs.
+        sindex, blob, offsets = dict(), bytearray(), array('q', [0])
+        f = _drf_lines(drffile)
+        while True:
+            chunk = list(islice(f, chunksize))
+            if not chunk:
+                break
+            if id_width == 0 and chunk[0][0] == ' ':
+                first = chunk[0].split()[0]
+                id_width = chunk[0].index(first) + len(first)
+            tokens = ''.join(chunk).split()
+            assert len(tokens) == 5 * len(chunk)
+            for col, k in (('time', 1), ('occupancy', 2), ('energy', 4)):
+                decimals[col] = max([decimals[col]] + [_decimals(t) for t in set(tokens[k::5])])
+            cols['id'].append(np.array(tokens[0::5], dtype = np.int64))
+            cols['time'].append(np.array(tokens[1::5], dtype = np.float64))
+            cols['occupancy'].append(np.array(tokens[2::5], dtype = np.float64))
+            cols['energy'].append(np.array(tokens[4::5], dtype = np.float64))
+            structures = tokens[3::5]
+            for ss in dict.fromkeys(structures):
+                if ss not in sindex:
+                    sindex[ss] = len(sindex)
+                    blob += ss.encode('ascii')
+                    offsets.append(len(blob))
+            cols['structure'].append(np.fromiter(map(sindex.__getitem__, structures),
+                                                 dtype = np.uint32, count = len(structures)))
+
+        self = cls.__new__(cls)
+        self.path = None
+        self.meta = {'version': _STORE_VERSION,
+                     'source': os.path.basename(drffile),
+                     'decimals': decimals,
+                     'id_width': id_width}
+        for col, dtype in _COLUMNS.items():
+            setattr(self, col, np.concatenate(cols[col]) if cols[col] else
+                               np.zeros(0, dtype = dtype))
+        self.ss_blob = np.frombuffer(bytes(blob), dtype = np.uint8)
+        self.ss_offsets = np.asarray(offsets, dtype = np.int64)
+        return self
+
+    def save(self, storedir):
+        """Write the store into a directory (created if it does not exist)."""
+        os.makedirs(storedir, exist_ok = True)
+        for col in list(_COLUMNS) + ['ss_blob', 'ss_offsets']:
+            np.save(os.path.join(storedir, f'{col}.npy'), getattr(self, col))
+        with open(os.path.join(storedir, 'meta.json'), 'w') as mf:
+            json.dump(self.meta, mf)
+        return DrfStore(storedir)
+
+    def __len__(self):
+        return len(self.id)
+
+    @property
+    def num_structures(self):
+        return len(self.ss_offsets) - 1
+
+    @property
+    def ss_lengths(self):
+        """Length of every unique structure."""
+        return np.diff(self.ss_offsets)
+
+    @property
+    def lengths(self):
+        """Structure length (i.e. transcript length) of every line."""
+        return self.ss_lengths[self.structure]
+
+    def ss_bytes(self, k):
+        """The unique structure k as uint8 array (no copy)."""
+        return self.ss_blob[self.ss_offsets[k]:self.ss_offsets[k+1]]
+
+    def ss(self, k):
+        """The unique structure k as dot-bracket string."""
+        return self.ss_bytes(k).tobytes().decode('ascii')
+
+    def ss_matrix(self, ks = None, fill = ord(' ')):
+        """Unique structures as one (structures x max. length) uint8 matrix.
+
+        Positions beyond the length of a structure are set to fill.
+
+        Args:
+          ks (array, optional): The structures of the matrix rows, defaults
+            to all unique structures. Use this to limit the memory footprint.
+          fill (int, optional): The fill byte.
+        """
+        ks = np.arange(self.num_structures) if ks is None else np.asarray(ks, dtype = np.int64)
+        lengths = self.ss_lengths[ks]
+        width = int(lengths.max()) if len(lengths) else 0
+        pos = np.arange(width)
+        valid = pos < lengths[:, None]
+        matrix = np.full((len(ks), width), fill, dtype = np.uint8)
+        matrix[valid] = self.ss_blob[(self.ss_offsets[ks, None] + pos)[valid]]
+        return matrix
+
+    def lines(self, chunksize = 1 << 16):
+        """Yield (id, time, occupancy, structure, energy) for every line.
+
+        The values are of the same type as returned by :func:`parse_drf`.
+        """
+        sscache = [self.ss(k) for k in range(self.num_structures)]
+        for lo in range(0, len(self), chunksize):
+            hi = lo + chunksize
+            cols = [getattr(self, col)[lo:hi].tolist() for col in
+                        ('id', 'time', 'occupancy', 'structure', 'energy')]
+            for ni, time, occu, k, en in zip(*cols):
+                yield ni, time, occu, sscache[k], en
+
+    def to_drf(self, drffile):
+        """Write the store back into the text *.drf format."""
+        td, od, ed = (self.meta['decimals'][col] for col in ('time', 'occupancy', 'energy'))
+        iw = self.meta['id_width']
+        with open(drffile, 'w') as df:
+            df.write(DRF_HEADER)
+            for ni, time, occu, ss, en in self.lines():
+                df.write(f'{ni:{iw}d} {time:.{td}f} {occu:.{od}f} {ss} {en:6.{ed}f}\n')
+
+def parse_drf(drffile):
+    """Yield (id, time, occupancy, structure, energy) for every line of a drf file.
+
+    The input may be a text *.drf file, a *.drt trajectory (see
+    :mod:`drconverters.trajectory`) or a binary drf store.
+
+    Args:
+      drffile (str): Path to a *.drf file or a drf store directory.
+
+    Yields:
+      int, float, float, str, float: One tuple per line of the drf file.
+    """
+    if is_drf_store(drffile):
+        yield from DrfStore(drffile).lines()
+        return
+    for line in _drf_lines(drffile):
+        ni, time, occu, ss, en = line.split()
+        yield int(ni), float(time), float(occu), ss, float(en)
+
+def open_drf(drffile):
+    """Return a :obj:`DrfStore` for a drf store directory or a text *.drf file.
+
+    Stores are memory-mapped, text files are parsed into memory.
+    """
+    if is_drf_store(drffile):
+        return DrfStore(drffile)
+    return DrfStore.from_drf(drffile)
+
+def drf_to_store(drffile, storedir):
+    """Convert a text *.drf file into a binary drf store.
+
+    Args:
+      drffile (str): The *.drf input file.
+      storedir (str): The output directory (created if it does not exist).
+
+    Returns:
+      :obj:`DrfStore`: A memory-mapped reader for the new store.
+    """
+    return DrfStore.from_drf(drffile).save(storedir)
+
+def main():
+    """Convert between the text *.drf format and the binary drf store.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+        description = 'DrfStore: Convert *.drf files to and from a binary drf store.')
+    parser.add_argument('--version', action = 'version',
+            version = '%(prog)s ' + __version__)
+    parser.add_argument("input", metavar = '<str>',
+            help = """A text *.drf file (converted to a store) or a drf store
+            directory (converted back to text).""")
+    parser.add_argument("output", metavar = '<str>',
+            help = "Name of the output store directory or *.drf file.")
+    parser.add_argument("-f", "--force", action = "store_true",
+            help = "Overwrite an existing output.")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output) and not args.force:
+        raise SystemExit(f'Output exists: {args.output} (use --force to overwrite).')
+
+    if is_drf_store(args.input):
+        DrfStore(args.input).to_drf(args.output)
+    else:
+        store = drf_to_store(args.input, args.output)
+        print(f'[Done:] Stored {len(store)} lines with {store.num_structures} unique structures.')
+
+if __name__ == '__main__':
+    main()
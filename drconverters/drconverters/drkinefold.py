@@ -5,20 +5,23 @@
 #
 import os
 import sys
-import math
 import string
 import argparse
 import numpy as np
 import subprocess as sub
-from random import randint
+from random import SystemRandom
 from packaging import version
 from glob import glob
+from heapq import heappop, heappush
+from functools import lru_cache
+from multiprocessing import Pool
 
 import RNA
 from . import __version__
 from .utils import (parse_vienna_stdin, 
                    get_drf_output_times, 
                    combine_drfs)
+from .trajectory import write_drt, expand_records, transcript_lengths
 
 _MIN_VRNA_VERSION = "2.5.1"
 if version.parse(RNA.__version__) < version.parse(_MIN_VRNA_VERSION):
@@ -32,9 +35,15 @@ def parse_kinefold_structure(line1, line2):
      =>
      . . ( ( ( ( ( ( . . . . [ [ [ [ . . . ) ) ) ) ) ) ] ] ] ] . . . . . .
     """
+    separators = (' ', '-', "'")
+    # The end of the helix label that starts at every position of line2.
+    lend = [len(line2)] * len(line2)
+    for j in range(len(line2) - 2, -1, -1):
+        lend[j] = lend[j+1] if line2[j+1] not in separators else j+1
     hdict = {}
     havail = [True for _ in range(26+1)]
-    sseq, sstr = '', ''
+    hfree = list(range(26+1)) # Heap of available helix IDs.
+    sseq, sstr = [], []
     lx, lc, c = '', '', '.'
     for j, (x, y) in enumerate(zip(line1, line2)):
         if x == y:
@@ -42,8 +51,8 @@ def parse_kinefold_structure(line1, line2):
             continue
         if x in ('ACGU'):
             # Append the previous x, c to strings.
-            sseq += lx
-            sstr += lc
+            sseq.append(lx)
+            sstr.append(lc)
             lx = x
             lc = c
         elif x == '[' or x == '^':
@@ -52,15 +61,11 @@ def parse_kinefold_structure(line1, line2):
         elif x == ']':
             # An unpaired strech will follow
             c = '.'
-        if c == '|' and y not in (' ', '-', "'"):
+        if c == '|' and y not in separators:
             # y = the full ID of the current helix.
-            jj = j
-            while line2[jj+1] not in (' ', '-', "'"):
-                y += line2[jj+1] 
-                jj += 1
-    
+            y = line2[j:lend[j]]
             if y not in hdict:
-                myid = havail.index(True) # First occurrence of True in ID list
+                myid = heappop(hfree) # Lowest available ID.
                 hdict[y] = [myid, j, None]
                 hid = hdict[y][0]
                 c = '(' if hid == 0 else string.ascii_letters[hid - 1 + 26]
@@ -69,20 +74,38 @@ def parse_kinefold_structure(line1, line2):
                 hdict[y][2] = j
                 hid = hdict[y][0]
                 c = ')' if hid == 0 else string.ascii_letters[hid - 1 ]
-                havail[hid] = True
+                if not havail[hid]:
+                    havail[hid] = True
+                    heappush(hfree, hid)
             lc = c
-    sseq += lx
-    sstr += lc
-    return sseq, sstr
+    sseq.append(lx)
+    sstr.append(lc)
+    return ''.join(sseq), ''.join(sstr)
 
+@lru_cache(maxsize = 1 << 16)
+def translate_kinefold_structure(line1, line2):
+    """Sequence and dot-bracket structure of a Kinefold line pair.
 
-def rnm_to_drf(rnmfile, drffile, times, t_ext):
-    """Translates Kinefold *.rnm file to DrForna *.drf file.
-    """ 
+    Pseudoknotted helices are translated into ViennaRNA bracket notation.
+    Results are cached, as Kinefold repeats the same lines many times.
+    """
+    sseq, sstr = parse_kinefold_structure(line1, line2)
+    return sseq, RNA.db_from_ptable(RNA.ptable(sstr, RNA.BRACKETS_ANY))
+
+
+def parse_rnm(rnmfile, t_ext):
+    """Parse a Kinefold *.rnm file.
+
+    The translated structures are also written into the file {rnmfile}.log.
+
+    Returns:
+      str, str, list: The sequence, the name and (id, stop time, structure,
+      energy) for every structure (see :func:`drconverters.trajectory.write_drt`).
+    """
+    records = []
     idc = 0
-    with open(rnmfile, 'r') as rnm, open(drffile, 'w') as drf, open(rnmfile + '.log', 'w') as log:
-        drf.write(f"id time occupancy structure energy\n")
-        t, delay = 0, None
+    with open(rnmfile, 'r') as rnm, open(rnmfile + '.log', 'w') as log:
+        delay = None
         lsstr = '.'
         for i, line in enumerate(rnm, 1):
             line = line.rstrip()
@@ -101,35 +124,35 @@ def rnm_to_drf(rnmfile, drffile, times, t_ext):
                 en, eunit, _, _, ms, tunit = info.split()[0:6]
                 assert eunit == 'kcal/mol'
                 assert tunit == 'ms,'
-                sseq, sstr = parse_kinefold_structure(subseq.rstrip(), substr.rstrip())
-                sstr = RNA.db_from_ptable(RNA.ptable(sstr, RNA.BRACKETS_ANY))
+                sseq, sstr = translate_kinefold_structure(subseq.rstrip(), substr.rstrip())
                 stime = float(ms) * 10**(-3)
                 if delay is None:
                     delay = len(sstr) * t_ext
                 stime += delay
                 log.write(f'# {float(ms) * 10**(-3):13.9f} {stime:13.9f} {sstr} {float(en):6.2f}\n')
-                while t < len(times) and times[t] <= stime:
-                    tlen = round(times[t]/t_ext) if np.isclose(round(times[t]/t_ext, 9), 
-                                                               times[t]/t_ext) else math.ceil(times[t]/t_ext)
-                    if tlen == 0:
-                        tlen = 1
-                    elif tlen > len(seq):
-                        tlen = len(seq)
-                    if len(lsstr) < tlen:
-                        lsstr += '.' * (tlen-len(lsstr))
-                    elif len(lsstr) > tlen:
-                        # If this happens, check that only unpaired nucleotides
-                        # are removed at the end... otherwise it's a problem!
-                        raise ValueError('This case has never been observed before!')
-                        lsstr = lsstr[:tlen]
-                    assert len(lsstr) == tlen
-                    drf.write(f'{idc:>5d} {times[t]:13.9f} 1 {lsstr} {float(en):6.2f}\n')
-                    t += 1
+                # The previous structure is present until stime.
+                records.append((idc, stime, lsstr, en))
                 lsstr = sstr
                 idc += 1
-        while t < len(times):
-            drf.write(f'{idc:>5d} {times[t]:13.9f} 1 {lsstr} {float(en):6.2f}\n')
-            t += 1
+        records.append((idc, float('inf'), lsstr, en))
+    return seq, name, records
+
+def rnm_to_drt(rnmfile, drtfile, t_ext, t_end, t_lin, t_log):
+    """Translates Kinefold *.rnm file to a run-length encoded *.drt file.
+    """
+    seq, name, records = parse_rnm(rnmfile, t_ext)
+    write_drt(drtfile, records, len(seq), t_ext, t_end, t_lin, t_log, pad = True)
+    return seq, name
+
+def rnm_to_drf(rnmfile, drffile, times, t_ext):
+    """Translates Kinefold *.rnm file to DrForna *.drf file.
+    """ 
+    seq, name, records = parse_rnm(rnmfile, t_ext)
+    lengths = transcript_lengths(times, t_ext, len(seq))
+    with open(drffile, 'w') as drf:
+        drf.write(f"id time occupancy structure energy\n")
+        for (idc, t, ss, en) in expand_records(*zip(*records), times, lengths = lengths):
+            drf.write(f'{idc:>5d} {times[t]:13.9f} 1 {ss} {float(en):6.2f}\n')
     return seq, name
 
 def parse_drkinefold_args(parser):
@@ -146,6 +169,9 @@ def parse_drkinefold_args(parser):
     parser.add_argument("-p", "--processes", type = int, default = 0,
             help="Number of individual Kinefold system calls. By default, only existing data is processed.")
 
+    parser.add_argument("-c", "--cpus", type = int, default = None,
+            help="Maximal number of cpus used for threading.")
+
     parser.add_argument("--t-ext", type = float, default = 0.02, metavar = '<flt>',
             help = """Time per nucleotide extension (the inverse of the transcription rate)
             [s/nt].""")
@@ -161,17 +187,20 @@ def parse_drkinefold_args(parser):
     return
 
 
-def get_kinefold_input(name, i, seq, t_ext, t_end):
+def get_kinefold_input(name, i, seq, t_ext, t_end, seed = None):
     wdir = os.getcwd()
+    if seed is None:
+        seed, = get_kinefold_seeds(name, 1)
+    # Every run uses its own working files.
     return f"""\
-{randint(1, 10000)}	# random seed
-{wdir}/{name}.w
-{wdir}/{name}.w
+{seed}	# random seed
+{wdir}/{name}.{i:03d}.w
+{wdir}/{name}.{i:03d}.w
 {wdir}/{name}.{i:03d}.rnm
-{wdir}/{name}.w
-{wdir}/{name}.w
-{wdir}/{name}.w
-{wdir}/{name}.dat
+{wdir}/{name}.{i:03d}.w
+{wdir}/{name}.{i:03d}.w
+{wdir}/{name}.{i:03d}.w
+{wdir}/{name}.{i:03d}.dat
 0		# 0=RNA ; 1=DNA
 6.3460741	# helix minimum free energy in kcal/mol: 6.3460741=10kT
 10000000	# NA
@@ -183,6 +212,47 @@ def get_kinefold_input(name, i, seq, t_ext, t_end):
 """
 
 
+# Kinefold has always been called with seeds in this range.
+KINEFOLD_MAX_SEED = 10000
+
+def get_kinefold_seeds(name, num):
+    """Return num random seeds (1 to KINEFOLD_MAX_SEED) that have not been
+    used in any of the Kinefold input files {name}.*.in.
+
+    Raises:
+      ValueError: If there are less than num unused seeds.
+    """
+    used = set()
+    for infile in glob(f'{name}.*.in'):
+        with open(infile) as f:
+            used.add(int(f.readline().split()[0]))
+    unused = sorted(set(range(1, KINEFOLD_MAX_SEED + 1)) - used)
+    if num > len(unused):
+        raise ValueError(f'Only {len(unused)} unused Kinefold seeds left for {name}.')
+    return SystemRandom().sample(unused, num)
+
+def run_kinefold(name, seqname, i, seq, t_ext, t_end, t_lin, t_log, seed):
+    """Run Kinefold simulation #i and convert its *.rnm output to a *.drt file.
+
+    Returns:
+      str, str: The sequence and name found in the *.rnm file.
+    """
+    print(f'[in progress:] Calling Kinefold #{i}.')
+    rname = f'{name}.{i:03d}'
+    # The *.dat file seems to be required input?!?
+    with open(f'{rname}.dat', 'w') as dat:
+        dat.write(f'< {seqname}\n')
+        dat.write(f'{seq}\n')
+    infile = f'{rname}.in'
+    with open(infile, 'w') as k:
+        k.write(get_kinefold_input(name, i, seq, t_ext, t_end, seed))
+    kcall = ['./kinefold_long_static', infile, '-noprint']
+    sub.run(kcall, capture_output = True) 
+    for tmpfile in (f'{rname}.w', f'{rname}.i', f'{rname}.dat'): # clean up 
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return rnm_to_drt(f'{rname}.rnm', f'{rname}.drt', t_ext, t_end, t_lin, t_log)
+
 def main():
     """Translate Kinefold cotranscriptional folding output to DrForna input format.
     """
@@ -225,42 +295,40 @@ def main():
         os.mkdir(args.tmpdir)
     
     #
-    # The *.dat file seems to be required input?!?
-    #
-    if args.processes:
-        datf = os.path.join(args.tmpdir, f'{name}.dat')
-        if os.path.exists(datf):
-            print(f"WARNING: Overwriting existing file: {datf}")
-        with open(datf, 'w') as dat:
-            dat.write(f'< {name}\n')
-            dat.write(f'{seq}\n')
-
-    #
-    # Do --processes separate simulations.
-    #
-    for i in range(fid, args.processes+fid):
-        print(f'[in progress:] Calling Kinefold #{i}.')
-        infile = os.path.join(args.tmpdir, f'{name}.{i:03d}.in')
-        with open(infile, 'w') as k:
-            k.write(get_kinefold_input(f'{args.tmpdir}/{name}', i, seq, args.t_ext, args.t_end))
-        kcall = ['./kinefold_long_static', infile, '-noprint']
-        sub.run(kcall, capture_output = True) 
-    if args.processes: # clean up 
-        os.remove(f'{args.tmpdir}/{name}.w')
-        os.remove(f'{args.tmpdir}/{name}.i')
-
-    #
-    # Convert all rnmfiles to drffiles using the current time vector.
+    # Do --processes separate simulations and convert all rnmfiles to
+    # drtfiles. The drtfiles do not depend on the output times, so only
+    # missing or outdated drtfiles have to be converted.
     #
+    state = f'{args.tmpdir}/{name}.aggregate.npz'
+    rnmfiles = []
     for rnmfile in glob(f'{args.tmpdir}/{name}.*.rnm'):
-        drffile = rnmfile[:-3]+'drf'
-        kseq, kname = rnm_to_drf(rnmfile, drffile, times, args.t_ext)
-        assert kseq == seq and kname == name
+        # *.drf files of older versions are left alone (and not combined),
+        # the drtfile is converted from the same rnmfile.
+        drtfile = rnmfile[:-3]+'drt'
+        if os.path.exists(drtfile) and \
+                os.path.getmtime(drtfile) >= os.path.getmtime(rnmfile):
+            continue
+        rnmfiles.append(rnmfile)
+
+    seeds = get_kinefold_seeds(f'{args.tmpdir}/{name}', args.processes)
+    with Pool(processes = args.cpus) as q:
+        multiple_results = [q.apply_async(run_kinefold,
+            (f'{args.tmpdir}/{name}', name, i, seq, args.t_ext, args.t_end,
+             args.t_lin, args.t_log, seed))
+                for i, seed in zip(range(fid, args.processes+fid), seeds)]
+        multiple_results += [q.apply_async(rnm_to_drt, (rnmfile, rnmfile[:-3]+'drt',
+            args.t_ext, args.t_end, args.t_lin, args.t_log)) for rnmfile in rnmfiles]
+        for res in multiple_results:
+            kseq, kname = res.get()
+            assert kseq == seq and kname == name
 
     #
-    # Combine all drf files from individual simulations to one lage output file.
+    # Combine all drt files from individual simulations to one lage output file.
+    # The aggregate file in tmpdir remembers the simulations that have already
+    # been combined, only new (or re-converted) files are parsed.
     #
-    combine_drfs(f'{args.tmpdir}/{name}*.drf', f'{name}.drf', len(seq), times, use_counts = False)
+    combine_drfs(f'{args.tmpdir}/{name}*.drt', f'{name}.drf', len(seq), times, use_counts = False,
+                 cpus = args.cpus, state = state)
     return
 
 if __name__ == '__main__':
@@ -14,7 +14,12 @@ from multiprocessing import Pool
 from . import __version__
 from .utils import (parse_vienna_stdin, 
                     get_drf_output_times, 
-                    combine_drfs)
+                    count_structures,
+                    combine_drfs,
+                    update_aggregate,
+                    load_aggregate,
+                    DrfAggregate)
+from .trajectory import write_drt, sample_records, drt_output_times
 
 
 def syscall_kinfold(name, seq,
@@ -132,32 +137,60 @@ def sub_kinfold(*kargs, **kwargs):
                 yield line
     return
 
-def run_kinfold(times, basename, seq, num, atupernuc, atupersec, totkftime, temperature, params):
-    idc = 0
-    with open(f'{basename}.drf', 'w') as drf:
-        drf.write(f"id time occupancy structure energy\n")
-        t, nsim = 0, 0
-        for line in sub_kinfold(basename, seq, num = num, glen = 1, temp = temperature,
-                                params = params, grow = atupernuc, time = totkftime, 
-                                erange = 999999):
-            [ss, en, st] = line.split()[0:3]
-            stime = float(st)
-            # Add all drf output times until the give time step
-            while t < len(times) and times[t]*atupersec <= stime:
-                drf.write(f'{idc:>5d} {times[t]:13.9f} 1 {ss} {float(en):6.2f}\n')
-                t += 1
-            if len(line.split()) == 4:
-                if t < len(times):
-                    assert np.isclose(times[t]*atupersec, stime)
-                    drf.write(f'{idc:>5d} {times[t]:13.9f} 1 {ss} {float(en):6.2f}\n')
-                    t += 1
-                assert t == len(times)
-                t = 0
-                nsim += 1
-                print(f'[status update:] Done with simulation {nsim} in {basename}.drf. ', end = '\r')
-            idc += 1
+def kinfold_trajectory(basename, seq, num, atupernuc, atupersec, totkftime, temperature, params):
+    """Call Kinfold and yield (id, stop time, structure, energy) for every
+    structure of every simulation.
+
+    Stop times are in Kinfold's internal time units, the last structure of
+    every simulation stays until the end (stop time inf).
+    """
+    idc, nsim = 0, 0
+    for line in sub_kinfold(basename, seq, num = num, glen = 1, temp = temperature,
+                            params = params, grow = atupernuc, time = totkftime, 
+                            erange = 999999):
+        [ss, en, st] = line.split()[0:3]
+        if len(line.split()) == 4:
+            assert np.isclose(float(st), totkftime)
+            st = 'inf'
+            nsim += 1
+            print(f'[status update:] Done with simulation {nsim} in {basename}. ', end = '\r')
+        yield idc, st, ss, en
+        idc += 1
     print(f'[Done:] Kinfold call for {basename} finished after {nsim} simulations. ')
 
+def kinfold_output(times, basename, seq, num, atupernuc, atupersec, totkftime, temperature, params):
+    """Call Kinfold and yield (id, time index, structure, energy) for every
+    output time of every simulation.
+    """
+    records = kinfold_trajectory(basename, seq, num, atupernuc, atupersec,
+                                 totkftime, temperature, params)
+    yield from sample_records(records, times, scale = atupersec)
+
+def run_kinfold(grid, basename, seq, num, atupernuc, atupersec, totkftime, temperature, params):
+    """Call Kinfold and write the structures at the output times into
+    {basename}.drt, where every structure is stored once per run of output
+    times (Kinfold reports every single move, most of them happen between
+    two output times).
+
+    Args:
+      grid (dict): The parameters of the output times (see :func:`write_drt`).
+    """
+    times = drt_output_times(grid)
+    stops = times.tolist()[:-1] + [float('inf')]
+    records = ((ni, stops[t], ss, en) for (ni, t, ss, en) in
+                kinfold_output(times, basename, seq, num, atupernuc, atupersec,
+                               totkftime, temperature, params))
+    write_drt(f'{basename}.drt', records, **grid, sampled = True)
+
+def count_kinfold(times, basename, *kargs):
+    """Call Kinfold and count the structures at every output time, instead
+    of writing them into a trajectory file (see :func:`count_structures`).
+    """
+    # Round energies as in the drf file.
+    lines = ((t, ss, f'{float(en):.2f}') for (_, t, ss, en) in
+                kinfold_output(times, basename, *kargs))
+    return count_structures(lines, len(times))
+
 def parse_drkinfold_args(parser):
     parser.add_argument('--version', action = 'version', 
             version = '%(prog)s ' + __version__)
@@ -178,6 +211,19 @@ def parse_drkinfold_args(parser):
     parser.add_argument("-n", "--num", type = int, default = 1,
             help="Number of simulations per Kinfold call.")
 
+    parser.add_argument("--target-se", type = float, default = None, metavar = '<flt>',
+            help = """Adaptive mode: repeat batches of *--processes* Kinfold calls (or
+            one call per cpu) until the standard error of every occupancy at every
+            output time is below this value. Existing simulations are taken into account.""")
+
+    parser.add_argument("--max-processes", type = int, default = 1000, metavar = '<int>',
+            help = "Maximal number of Kinfold calls in adaptive mode.")
+
+    parser.add_argument("--no-drf-files", action = "store_true",
+            help = """Do not write a trajectory file (*.drt) per Kinfold call. The structures are
+            counted while Kinfold is running, and only the counts are added to the
+            combined output.""")
+
     parser.add_argument("--k0", type = float, default = 1e5, metavar = '<flt>',
             help = """Arrhenius rate constant. Adjust to relate free energy
             changes to experimentally determined folding time [atu/s].""")
@@ -230,9 +276,13 @@ def main():
     # Put everything in one directory, update the file ID in case there are
     # existing simulations.
     #
+    state = f'{args.tmpdir}/{name}.aggregate.npz'
+    agg = load_aggregate(state, len(seq), times)
     fid = 1 # Set initial file ID according to what can already be found in tmpdir.
     if os.path.exists(args.tmpdir):
-        for data in glob.glob(f'{args.tmpdir}/{name}.*.drf'):
+        # Simulations without output file are only listed in the aggregate.
+        merged = list(agg.files) if agg else []
+        for data in glob.glob(f'{args.tmpdir}/{name}.*.dr[ft]') + merged:
             ndata = data.split('/')[-1]
             *pre, nfid, suf = ndata.split('.')
             fid = max(fid, int(nfid)+1)
@@ -240,23 +290,63 @@ def main():
         os.mkdir(args.tmpdir)
 
     #
-    # Do all the Kinfold calculations.
+    # Do all the Kinfold calculations. In adaptive mode (--target-se), batches
+    # of Kinfold calls are repeated until the occupancies have converged.
     #
-    if args.processes:
-        # Conversion factors between seconds and Kinfold's internal time units.
-        atupersec = args.k0
-        atupernuc = atupersec * args.t_ext
-        totkftime = atupernuc * len(seq) + atupersec * args.t_end
+    # Conversion factors between seconds and Kinfold's internal time units.
+    atupersec = args.k0
+    atupernuc = atupersec * args.t_ext
+    totkftime = atupernuc * len(seq) + atupersec * args.t_end
+    if args.no_drf_files:
+        kinfold, output = count_kinfold, times
+    else:
+        # The trajectories are expanded onto the output times when they are combined.
+        kinfold, output = run_kinfold, dict(seqlen = len(seq), t_ext = args.t_ext,
+                t_end = args.t_end, t_lin = args.t_lin, t_log = args.t_log)
+    pattern = f'{args.tmpdir}/{name}*.dr[ft]'
+    batch = args.processes
+    if args.target_se and not batch:
+        batch = args.cpus if args.cpus else os.cpu_count()
+    ncalls = 0
+    while True:
+        if args.target_se:
+            agg = update_aggregate(pattern, len(seq), times, cpus = args.cpus, state = state)
+            se = agg.standard_errors().max()
+            print(f'[convergence:] {agg.nsim} simulations, max. standard error: {se:.4f} (target: {args.target_se}).')
+            if se <= args.target_se:
+                break
+            if ncalls >= args.max_processes:
+                print(f'[WARNING:] Not converged after {ncalls} Kinfold calls (see --max-processes).')
+                break
+        elif ncalls >= batch:
+            break
+
+        # The last batch of the adaptive mode stops at --max-processes.
+        size = min(batch, args.max_processes - ncalls) if args.target_se else batch
         with Pool(processes = args.cpus) as q:
-            multiple_results = [q.apply_async(run_kinfold, 
-                (times, f'{args.tmpdir}/{name}.{fid+x:03d}', seq, 
-                 args.num, atupernuc, atupersec, totkftime, args.temp, args.paramFile)) for x in range(args.processes)]
-            [res.get() for res in multiple_results]
+            multiple_results = [q.apply_async(kinfold, 
+                (output, f'{args.tmpdir}/{name}.{fid+x:03d}', seq, 
+                 args.num, atupernuc, atupersec, totkftime, args.temp, args.paramFile)) for x in range(size)]
+            results = [res.get() for res in multiple_results]
+
+        if args.no_drf_files:
+            # Merge the counts into the aggregate as if they were read from files.
+            if agg is None:
+                agg = DrfAggregate(len(seq), times)
+            for x, result in enumerate(results):
+                agg.merge(*result)
+                agg.files[f'{args.tmpdir}/{name}.{fid+x:03d}.drf'] = None
+            agg.save(state)
+        fid += size
+        ncalls += size
 
     #
-    # Combine all drf files from individual simulations to one lage output file.
+    # Combine all drf/drt files from individual simulations to one lage output file.
+    # The aggregate file in tmpdir remembers the simulations that have already
+    # been combined, only new files are parsed.
     #
-    combine_drfs(f'{args.tmpdir}/{name}*.drf', f'{name}.drf', len(seq), times, use_counts = False)
+    combine_drfs(pattern, f'{name}.drf', len(seq), times, use_counts = False,
+                 cpus = args.cpus, state = state)
 
 if __name__ == '__main__':
     main()
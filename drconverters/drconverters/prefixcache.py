@@ -0,0 +1,112 @@
+#
+# PrefixCache: An on-disk cache for thermodynamic properties of nascent transcripts.
+#
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def file_digest(filename):
+    """SHA1 hex digest of a file's content (None if filename is None)."""
+    if filename is None:
+        return None
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def array_digest(data):
+    """SHA1 hex digest of numeric data (None if data is None)."""
+    if data is None:
+        return None
+    return hashlib.sha1(np.ascontiguousarray(data, dtype = np.float64).tobytes()).hexdigest()
+
+_MD_ATTRIBUTES = ('temperature', 'betaScale', 'pf_smooth', 'dangles', 'special_hp',
+                  'noLP', 'noGU', 'noGUclosure', 'logML', 'circ', 'gquad',
+                  'max_bp_span', 'window_size', 'energy_set')
+
+def md_digest(md):
+    """A digest of all ViennaRNA model details that affect (partition) folding."""
+    return {a: getattr(md, a) for a in _MD_ATTRIBUTES if hasattr(md, a)}
+
+class PrefixCache:
+    """Content-addressed, on-disk cache with least-recently-used eviction.
+
+    Every entry is a ``*.npz`` file named by the SHA1 hash of its key. Entries
+    are written atomically, so multiple processes can share one cache
+    directory. The access time of an entry is recorded as file modification
+    time, :meth:`evict` removes the least recently used entries until the
+    cache is below its size limit.
+
+    Args:
+      path (str): The cache directory (created if it does not exist).
+      max_size (int, optional): Size limit in bytes. Defaults to 1 GiB.
+    """
+    def __init__(self, path, max_size = 1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok = True)
+
+    @staticmethod
+    def key(*parts):
+        """Hash of JSON-serializable key parts."""
+        return hashlib.sha1(json.dumps(parts, sort_keys = True).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], f'{key}.npz')
+
+    def get(self, key):
+        """Return the stored arrays as dict, or None if key is not in the cache."""
+        fname = self._file(key)
+        try:
+            with np.load(fname) as data:
+                entry = {k: data[k] for k in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(fname)
+        except FileNotFoundError: # evicted in the meantime
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, **arrays):
+        """Store arrays under key."""
+        fname = self._file(key)
+        os.makedirs(os.path.dirname(fname), exist_ok = True)
+        tmp = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, fname)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size.
+
+        Returns:
+          int: The number of removed entries.
+        """
+        entries, total = [], 0
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.npz'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        removed = 0
+        for (_, size, fname) in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,274 @@
+#
+# RdatFile: Random access to cotranscriptional SHAPE-Seq data in RDAT files.
+#
+import re
+import numpy as np
+
+_LENGTH_ID = re.compile(r'Length(\d+)')
+
+class RdatFile:
+    """Random access to the DATA rows of an RDAT file by length and datatype.
+
+    On first access, the file is scanned once to build a byte-offset index of
+    all DATA_ANNOTATION and DATA lines, the data values themselves are only
+    parsed when they are requested. Rows are identified by the transcript
+    length (annotation ID:Length<n>), the datatype (e.g. REACTIVITY or
+    READS) and the modifier (e.g. BzCN or none).
+
+    Args:
+      filename (str): Path to the RDAT file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._header = None
+        self._index = None
+
+    def _build_index(self):
+        header = {'NAME': None, 'SEQUENCE': None, 'OFFSET': 0, 'SEQPOS': None}
+        annotations, offsets = dict(), dict()
+        with open(self.filename, 'rb') as f:
+            pos = 0
+            for line in f:
+                if line.startswith(b'DATA'):
+                    tag, _, rest = line.partition(b'\t')
+                    if tag.startswith(b'DATA_ANNOTATION:'):
+                        annotations[int(tag[16:])] = rest.decode()
+                    elif tag.startswith(b'DATA:'):
+                        offsets[int(tag[5:])] = pos
+                elif line.startswith((b'NAME', b'SEQUENCE', b'OFFSET', b'SEQPOS')):
+                    key, _, value = line.decode().partition('\t')
+                    if key in header:
+                        header[key] = value.strip()
+                pos += len(line)
+        header['OFFSET'] = int(header['OFFSET'])
+        if header['SEQPOS'] is not None:
+            # E.g. A-2 U-1 C0 G1 ... (the nucleotide is optional)
+            header['SEQPOS'] = [int(p.lstrip('ACGUTN')) for p in header['SEQPOS'].split()]
+        self._header = header
+
+        self._index = dict() # (length, datatype, modifier) -> offset
+        for k, annotation in annotations.items():
+            if k not in offsets:
+                continue
+            info = dict(field.split(':', 1) for field in annotation.split() if ':' in field)
+            m = _LENGTH_ID.search(info.get('ID', ''))
+            if m:
+                length = int(m.group(1))
+            elif 'sequence' in info:
+                length = len(info['sequence'])
+            else:
+                continue
+            datatype = info.get('datatype', '').split(':')[0]
+            self._index[(length, datatype, info.get('modifier'))] = offsets[k]
+
+    @property
+    def name(self):
+        return self.header['NAME']
+
+    @property
+    def sequence(self):
+        return self.header['SEQUENCE']
+
+    @property
+    def offset(self):
+        """The sequence numbering offset (OFFSET)."""
+        return self.header['OFFSET']
+
+    @property
+    def seqpos(self):
+        """Sequence position of every data column (SEQPOS), or None."""
+        return self.header['SEQPOS']
+
+    @property
+    def header(self):
+        """The NAME, SEQUENCE, OFFSET and SEQPOS fields of the file."""
+        if self._header is None:
+            self._build_index()
+        return self._header
+
+    @property
+    def index(self):
+        """The mapping (length, datatype, modifier) -> byte offset of a DATA line."""
+        if self._index is None:
+            self._build_index()
+        return self._index
+
+    def _key(self, length, datatype, modifier):
+        if modifier is not None:
+            key = (length, datatype, modifier)
+            return key if key in self.index else None
+        keys = [key for key in self.index if key[:2] == (length, datatype)]
+        if len(keys) > 1:
+            raise ValueError(f'Multiple {datatype} rows for length {length}, specify the modifier.')
+        return keys[0] if keys else None
+
+    def lengths(self, datatype = 'REACTIVITY', modifier = None):
+        """Sorted list of all lengths with data of the given datatype."""
+        return sorted({l for (l, d, m) in self.index
+                            if d == datatype and modifier in (None, m)})
+
+    def row(self, length, datatype = 'REACTIVITY', modifier = None):
+        """The values of one DATA row (None if there is no such row)."""
+        for (_, values) in self.rows(datatype, modifier, [length]):
+            return values
+        return None
+
+    def rows(self, datatype = 'REACTIVITY', modifier = None, lengths = None):
+        """Yield (length, values) for every available DATA row of the given
+        lengths (defaults to all lengths), in the order of the file."""
+        if lengths is None:
+            lengths = self.lengths(datatype, modifier)
+        keys = (self._key(l, datatype, modifier) for l in lengths)
+        keys = sorted((key for key in keys if key is not None), key = self.index.get)
+        with open(self.filename, 'rb') as f:
+            for key in keys:
+                f.seek(self.index[key])
+                yield key[0], np.array(f.readline().split()[1:], dtype = np.float64)
+
+    def matrix(self, datatype = 'REACTIVITY', modifier = None, lengths = None):
+        """The DATA rows of the given lengths as (lengths x positions) matrix.
+
+        Column j is the j-th value of a DATA row, missing rows and values are
+        NaN. Only the requested rows are parsed.
+
+        Args:
+          datatype (str, optional): E.g. REACTIVITY or READS.
+          modifier (str, optional): Required if there are multiple rows per
+            length and datatype (e.g. READS for BzCN and none).
+          lengths (iterable, optional): Defaults to all available lengths.
+
+        Returns:
+          numpy.ndarray, numpy.ndarray: The lengths and the data matrix.
+        """
+        lengths = np.array(self.lengths(datatype, modifier) if lengths is None else
+                           list(lengths), dtype = np.int64)
+        rows = dict(self.rows(datatype, modifier, lengths.tolist()))
+        width = max(map(len, rows.values()), default = 0)
+        data = np.full((len(lengths), width), np.nan)
+        for e, l in enumerate(lengths.tolist()):
+            if l in rows:
+                data[e, :len(rows[l])] = rows[l]
+        return lengths, data
+
+    def positions(self):
+        """The nucleotide (1-based index in SEQUENCE) of every data column.
+
+        The columns are numbered by SEQPOS (or OFFSET+1, OFFSET+2, ... if
+        there is no SEQPOS line), and nucleotide = SEQPOS - OFFSET.
+        """
+        if self.seqpos is None:
+            return np.arange(1, len(self.sequence or '') + 1)
+        return np.array(self.seqpos, dtype = np.int64) - self.offset
+
+    def aligned(self, n, datatype = 'REACTIVITY', modifier = None):
+        """The data of all transcripts up to length n, aligned to the sequence.
+
+        Only the rows of lengths <= n are parsed. See :func:`length_matrix`.
+        """
+        lengths = [l for l in self.lengths(datatype, modifier) if l <= n]
+        lengths, data = self.matrix(datatype, modifier, lengths)
+        return length_matrix(lengths, data, n, self.positions())
+
+    def reactivities(self, lengths = None):
+        """Reactivity matrix, see :meth:`matrix`."""
+        return self.matrix('REACTIVITY', lengths = lengths)
+
+    def reads(self, modifier, lengths = None):
+        """Read count matrix of the given modifier (e.g. BzCN or none), see :meth:`matrix`."""
+        return self.matrix('READS', modifier, lengths = lengths)
+
+def length_matrix(lengths, data, n, positions = None):
+    """Arrange per-length data as (n+1) x (n+1) matrix M, where M[l, i] is the
+    value of nucleotide i in the transcript of length l.
+
+    Args:
+      lengths (array): The transcript length of every row of data.
+      data (array): A (lengths x columns) matrix.
+      n (int): Length of the full transcript.
+      positions (array, optional): The nucleotide (1-based) of every column.
+        Defaults to 1, 2, 3, ...
+
+    Returns:
+      numpy.ndarray: Row 0, column 0 and all values of nucleotides i > l
+      or lengths l > n are NaN.
+    """
+    data = np.asarray(data, dtype = np.float64)
+    lengths = np.asarray(lengths, dtype = np.int64)
+    if positions is None:
+        positions = np.arange(1, data.shape[1] + 1)
+    positions = np.asarray(positions[:data.shape[1]], dtype = np.int64)
+    cols = np.flatnonzero((positions >= 1) & (positions <= n))
+    rows = np.flatnonzero((lengths >= 1) & (lengths <= n))
+    matrix = np.full((n + 1, n + 1), np.nan)
+    matrix[lengths[rows, None], positions[None, cols]] = data[rows[:, None], cols]
+    matrix[np.arange(n + 1)[:, None] < np.arange(n + 1)] = np.nan
+    return matrix
+
+def read_depth(rdat, lengths):
+    """Total number of reads (all modifiers) for every length, NaN if the
+    file has no READS for a length."""
+    depth = np.zeros(len(lengths))
+    found = np.zeros(len(lengths), dtype = bool)
+    for modifier in {m for (_, d, m) in rdat.index if d == 'READS'}:
+        _, reads = rdat.reads(modifier, lengths)
+        depth += np.nansum(reads, axis = 1)
+        found |= ~np.isnan(reads).all(axis = 1)
+    depth[~found] = np.nan
+    return depth
+
+def merge_replicates(rdats, lengths = None):
+    """Combine the reactivities of replicate RDAT files.
+
+    The data is aligned by transcript length and nucleotide (all files must
+    describe the same sequence, the data columns of every file are mapped to
+    nucleotides with :meth:`RdatFile.positions`, columns before the first
+    nucleotide are dropped), and the statistics are computed for all lengths
+    and positions at once. The read-weighted mean uses the total
+    number of reads of a length as weight. Replicates without READS are
+    weighted with the mean read depth of the other replicates, or equally if
+    no replicate has READS for this length.
+
+    Args:
+      rdats (list): A list of :obj:`RdatFile` objects.
+      lengths (iterable, optional): Defaults to all lengths with reactivities.
+
+    Returns:
+      numpy.ndarray, dict: The lengths and a (lengths x positions) matrix
+      for each of 'mean', 'sd' and 'weighted', where column j is nucleotide
+      j+1 (NaN where there is no data).
+    """
+    sequences = [r.sequence for r in rdats if r.sequence]
+    if any(not s.startswith(t) and not t.startswith(s) for s in sequences for t in sequences):
+        raise ValueError('Replicates have different sequences.')
+    if lengths is None:
+        lengths = sorted(set().union(*(r.lengths('REACTIVITY') for r in rdats)))
+    lengths = np.array(list(lengths), dtype = np.int64)
+
+    columns = []
+    for r in rdats:
+        m = r.reactivities(lengths)[1]
+        positions = r.positions()
+        if len(positions) < m.shape[1]:
+            raise ValueError(f'{r.filename}: more data columns than sequence positions.')
+        positions = positions[:m.shape[1]]
+        keep = np.flatnonzero(positions >= 1)
+        columns.append((positions[keep] - 1, m[:, keep]))
+    width = max((c.max() + 1 for (c, _) in columns if len(c)), default = 0)
+    data = np.full((len(rdats), len(lengths), width), np.nan)
+    for e, (c, m) in enumerate(columns):
+        data[e][:, c] = m
+    depth = np.array([read_depth(r, lengths) for r in rdats])
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        fill = np.nansum(depth, axis = 0) / np.sum(~np.isnan(depth), axis = 0)
+        weights = np.where(np.isnan(depth), fill, depth)
+        weights[:, np.isnan(fill)] = 1
+
+        valid = ~np.isnan(data)
+        values = np.where(valid, data, 0)
+        count = valid.sum(axis = 0)
+        mean = values.sum(axis = 0) / count
+        sqdev = np.where(valid, (data - mean) ** 2, 0).sum(axis = 0)
+        sd = np.where(count > 1, np.sqrt(sqdev / (count - 1)), np.nan)
+        w = weights[:, :, None] * valid
+        weighted = (w * values).sum(axis = 0) / w.sum(axis = 0)
+    return lengths, {'mean': mean, 'sd': sd, 'weighted': weighted}
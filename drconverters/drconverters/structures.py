@@ -0,0 +1,82 @@
+#
+# Compact, interned storage of secondary structures.
+#
+
+# Nested structures are packed with 2 bits per character, 4 characters per
+# byte. Code 3 pads the last byte, such that the length is encoded as well.
+# The characters are the base-4 digits of the packed bytes (big-endian).
+_DIGITS = str.maketrans('.()', '012')
+_DECODE = [''.join('.()'[(b >> s) & 3] for s in (6, 4, 2, 0) if (b >> s) & 3 != 3)
+                for b in range(256)]
+
+def pack_structure(ss):
+    """Pack a dot-bracket string into a hashable, compact key.
+
+    Structures consisting only of '.', '(' and ')' are packed into bytes
+    (4 characters per byte), others (e.g. pseudoknotted structures) are
+    returned unchanged.
+    """
+    if ss.encode('ascii').translate(None, b'.()'):
+        return ss
+    digits = ss.translate(_DIGITS) + '3' * (-len(ss) % 4)
+    return int(digits, 4).to_bytes(len(digits) // 4, 'big') if digits else b''
+
+def unpack_structure(key):
+    """The dot-bracket string of a key returned by :func:`pack_structure`."""
+    if isinstance(key, str):
+        return key
+    return ''.join(map(_DECODE.__getitem__, key))
+
+class StructureTable:
+    """Map secondary structures to consecutive integer IDs.
+
+    IDs are assigned in order of first appearance. Every structure is stored
+    once, in packed form (see :func:`pack_structure`), and is only expanded
+    to a dot-bracket string on access.
+    """
+    __slots__ = ('_index', '_keys')
+
+    def __init__(self, structures = ()):
+        self._index = dict() # Packed structure -> ID
+        self._keys = [] # ID -> Packed structure
+        for ss in structures:
+            self.intern(ss)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, k):
+        return unpack_structure(self._keys[k])
+
+    def __iter__(self):
+        return map(unpack_structure, self._keys)
+
+    def __contains__(self, ss):
+        return pack_structure(ss) in self._index
+
+    def __getstate__(self):
+        return self._keys
+
+    def __setstate__(self, keys):
+        self._keys = keys
+        self._index = {key: k for k, key in enumerate(keys)}
+
+    def intern(self, ss):
+        """Return the ID of a dot-bracket string, add it if necessary."""
+        return self.intern_key(pack_structure(ss))
+
+    def intern_key(self, key):
+        """Return the ID of a packed structure, add it if necessary."""
+        k = self._index.get(key)
+        if k is None:
+            k = self._index[key] = len(self._keys)
+            self._keys.append(key)
+        return k
+
+    def key(self, k):
+        """The packed form of structure k."""
+        return self._keys[k]
+
+    def get(self, ss, default = None):
+        """Return the ID of a dot-bracket string (or default)."""
+        return self._index.get(pack_structure(ss), default)
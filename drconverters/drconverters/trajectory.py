@@ -0,0 +1,183 @@
+#
+# Run-length encoded trajectories: *.drt files store only the state changes of
+# every simulation (or of its structures at the output times), they are
+# expanded onto the *.drf output times on the fly.
+#
+import json
+import numpy as np
+
+DRT_TAG = '#drt'
+DRT_HEADER = "id stop structure energy\n"
+
+def is_drt_file(fname):
+    """True if fname is a trajectory file written by :func:`write_drt`."""
+    try:
+        with open(fname) as f:
+            return f.readline().startswith(DRT_TAG)
+    except (OSError, UnicodeDecodeError):
+        return False
+
+def transcript_lengths(times, t_ext, seqlen):
+    """Length of the transcript at every output time.
+
+    Times that are (numerically) a multiple of t_ext belong to the shorter
+    transcript, the result is limited to the range [1, seqlen].
+    """
+    steps = np.asarray(times, dtype = np.float64) / t_ext
+    tlen = np.where(np.isclose(np.round(steps, 9), steps), np.round(steps), np.ceil(steps))
+    return np.clip(tlen, 1, seqlen).astype(np.int64).tolist()
+
+def write_drt(drtfile, records, seqlen, t_ext, t_end, t_lin, t_log, scale = 1, pad = False,
+              sampled = False):
+    """Write a run-length encoded trajectory file.
+
+    Every record (id, stop, structure, energy) means that the structure is
+    present at all output times up to (and including) stop. The last record
+    of every simulation must have stop = inf, consecutive records with the
+    same id, structure and energy are combined.
+
+    Args:
+      drtfile (str): The output file.
+      records (iterable): (id, stop, structure, energy), where stop may be a
+        string and the energy is in kcal/mol.
+      seqlen, t_ext, t_end, t_lin, t_log: The parameters of the default
+        output times (see :func:`drconverters.utils.get_drf_output_times`).
+      scale (float, optional): Stop times are in units of seconds * scale.
+      pad (bool, optional): Extend structures with unpaired nucleotides to
+        the transcript length at every output time.
+      sampled (bool, optional): The records are the structures at the
+        default output times (see :func:`sample_records`), the file cannot
+        be expanded onto other output times.
+
+    Returns:
+      int: The number of simulations.
+    """
+    meta = {'seqlen': seqlen, 't_ext': t_ext, 't_end': t_end, 't_lin': t_lin,
+            't_log': t_log, 'scale': scale, 'pad': pad, 'sampled': sampled}
+    nsim = 0
+    with open(drtfile, 'w') as drt:
+        drt.write(f'{DRT_TAG} {json.dumps(meta)}\n')
+        drt.write(DRT_HEADER)
+        last = None
+        for (ni, stop, ss, en) in records:
+            en = f'{float(en):.2f}'
+            stop = float(stop)
+            if last is not None and last[0] == ni and last[2] == ss and last[3] == en:
+                last[1] = stop
+            else:
+                if last is not None:
+                    drt.write('{:d} {!r} {} {}\n'.format(*last))
+                last = [ni, stop, ss, en]
+            if np.isinf(stop):
+                drt.write('{:d} {!r} {} {}\n'.format(*last))
+                last = None
+                nsim += 1
+        assert last is None, 'Incomplete simulation in trajectory.'
+    return nsim
+
+def read_drt(drtfile):
+    """Return the metadata and the records of a trajectory file.
+
+    Returns:
+      dict, list, numpy.ndarray, list, list: The header of the file, and the
+      ids, stop times, structures and energies of all records.
+    """
+    with open(drtfile) as f:
+        meta = _read_meta(f)
+        assert next(f) == DRT_HEADER
+        tokens = f.read().split()
+    assert len(tokens) % 4 == 0
+    ids = list(map(int, tokens[0::4]))
+    stops = np.array(tokens[1::4], dtype = np.float64)
+    return meta, ids, stops, tokens[2::4], tokens[3::4]
+
+def _read_meta(f):
+    tag, meta = next(f).split(maxsplit = 1)
+    assert tag == DRT_TAG
+    return json.loads(meta)
+
+def drt_output_times(meta):
+    """The default output times of a trajectory file."""
+    from .utils import get_drf_output_times
+    return get_drf_output_times(meta['seqlen'], meta['t_ext'], meta['t_end'],
+                                meta['t_lin'], meta['t_log'])
+
+def expand_records(ids, stops, structures, energies, times, scale = 1, lengths = None):
+    """Yield (id, time index, structure, energy) for every output time of
+    every complete simulation.
+
+    The structure at an output time is the first record of a simulation with
+    a stop time greater or equal to the output time.
+
+    Args:
+      ids, stops, structures, energies: The records of consecutive
+        simulations, the last record of every simulation has stop = inf.
+      times (array): The output times (in seconds).
+      scale (float, optional): Stop times are in units of seconds * scale.
+      lengths (list, optional): Transcript length at every output time, used
+        to extend structures with unpaired nucleotides.
+    """
+    stops = np.asarray(stops, dtype = np.float64)
+    x = np.asarray(times, dtype = np.float64) * scale
+    lo = 0
+    for hi in (np.flatnonzero(np.isinf(stops)) + 1).tolist():
+        rec = (lo + np.searchsorted(np.maximum.accumulate(stops[lo:hi]), x)).tolist()
+        for t, r in enumerate(rec):
+            ss = structures[r]
+            if lengths is not None and len(ss) != lengths[t]:
+                if len(ss) > lengths[t]:
+                    # If this happens, check that only unpaired nucleotides
+                    # are removed at the end... otherwise it's a problem!
+                    raise ValueError('This case has never been observed before!')
+                ss += '.' * (lengths[t] - len(ss))
+            yield ids[r], t, ss, energies[r]
+        lo = hi
+
+def sample_records(records, times, scale = 1):
+    """Yield (id, time index, structure, energy) for every output time of
+    every simulation in a stream of records (see :func:`write_drt`).
+
+    Same as :func:`expand_records`, but the records are consumed one after
+    the other, i.e. simulations of any length are never held in memory.
+    """
+    x = (np.asarray(times, dtype = np.float64) * scale).tolist()
+    t = 0
+    for (ni, stop, ss, en) in records:
+        stop = float(stop)
+        while t < len(x) and x[t] <= stop:
+            yield ni, t, ss, en
+            t += 1
+        if stop == float('inf'):
+            assert t == len(x), 'Incomplete simulation in trajectory.'
+            t = 0
+    assert t == 0, 'Incomplete simulation in trajectory.'
+
+def expand_drt(drtfile, times = None):
+    """Yield (id, time index, structure, energy) for every output time of
+    every simulation in a trajectory file.
+
+    Args:
+      drtfile (str): A file written by :func:`write_drt`.
+      times (array, optional): The output times. Defaults to the output times
+        given in the header of the file.
+    """
+    meta, ids, stops, structures, energies = read_drt(drtfile)
+    if times is None:
+        times = drt_output_times(meta)
+    elif meta.get('sampled'):
+        default = drt_output_times(meta)
+        if len(times) != len(default) or not np.allclose(times, default):
+            raise ValueError(f'{drtfile} is sampled on different output times.')
+    lengths = transcript_lengths(times, meta['t_ext'], meta['seqlen']) if meta['pad'] else None
+    yield from expand_records(ids, stops, structures, energies, times,
+                              scale = meta['scale'], lengths = lengths)
+
+def drt_lines(drtfile, times = None):
+    """Yield the lines of the *.drf file that corresponds to a trajectory file
+    (without header), see :func:`expand_drt`."""
+    if times is None:
+        with open(drtfile) as f:
+            times = drt_output_times(_read_meta(f))
+    tstr = [f'{time:13.9f}' for time in times]
+    for (ni, t, ss, en) in expand_drt(drtfile, times):
+        yield f'{ni:>5d} {tstr[t]} 1 {ss} {float(en):6.2f}\n'
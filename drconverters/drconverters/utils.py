@@ -1,7 +1,17 @@
 import os
+import re
+import json
+from array import array
 from glob import glob
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 import numpy as np
 
+from .drfstore import DRF_HEADER
+from .structures import StructureTable, pack_structure
+from .trajectory import is_drt_file, expand_drt
+
 
 def parse_vienna_stdin(stdin, chars='ACGUNTacgunt'):
     """Parse name and sequence from file with fasta format.
@@ -38,71 +48,333 @@ def get_drf_output_times(seqlen, t1, t8, t_lin, t_log):
     ntime = np.logspace(np.log10(times[-1]), np.log10(times[-1] + t8), t_log + 1)
     return np.concatenate([times, ntime[1:]])
 
-def combine_drfs(drffiles, oname, seqlen, times, use_counts = False, get_kp8 = False):
-    #
-    # Collect data from all drf output files.
-    #
-    cdict = {t: dict() for t in range(len(times))} # Counts
-    edict = {t: dict() for t in range(len(times))} # Energy
-    idict, nid = dict(), 0 # Identity
-    nfiles, nsim = 0, 0
-    for data in glob(drffiles):
-        nfiles += 1
-        with open(data) as dat:
-            t = 0
-            for i, line in enumerate(dat):
-                if i == 0:
-                    continue
-                _, time, occ, ss, en = line.split()
+def weighted_stats(groups, values, weights, ngroups = None):
+    """Quantiles, mean and range of weighted values for every group.
+
+    The results correspond to expanding every value into a list with weight
+    copies and using linearly interpolated quantiles (the numpy and pandas
+    default), but the cost is O(k log k) for k (value, weight) pairs.
+
+    Args:
+      groups (array): Non-negative integer group of every value.
+      values (array): The values.
+      weights (array): Non-negative integer weight (multiplicity) of every value.
+      ngroups (int, optional): Number of groups. Defaults to max(groups) + 1.
+
+    Returns:
+      numpy.ndarray: A (ngroups x 6) array with the columns Q25, Q75, median,
+      mean, min and max. Groups without values are NaN.
+    """
+    groups = np.asarray(groups, dtype = np.int64)
+    values = np.asarray(values, dtype = np.float64)
+    weights = np.asarray(weights, dtype = np.int64)
+    keep = weights > 0
+    groups, values, weights = groups[keep], values[keep], weights[keep]
+    if ngroups is None:
+        ngroups = int(groups.max()) + 1 if len(groups) else 0
+    order = np.lexsort((values, groups))
+    groups, values, weights = groups[order], values[order], weights[order]
+
+    cumw = np.cumsum(weights)
+    total = np.zeros(ngroups, dtype = np.int64)
+    np.add.at(total, groups, weights)
+    base = np.cumsum(total) - total
+
+    def value_at(rank):
+        # The value at the given rank of the (virtually) expanded list.
+        return values[np.searchsorted(cumw, rank, side = 'right')]
+
+    stats = np.full((ngroups, 6), np.nan)
+    has = total > 0
+    n, b = total[has], base[has]
+    for col, q in ((0, 0.25), (1, 0.75)):
+        h = (n - 1) * q
+        lo = np.floor(h)
+        t = h - lo
+        lo = lo.astype(np.int64)
+        a, c = value_at(b + lo), value_at(b + np.minimum(lo + 1, n - 1))
+        # Same as numpy's linear interpolation.
+        stats[has, col] = np.where(t >= 0.5, c - (c - a) * (1 - t), a + (c - a) * t)
+    mid = n // 2
+    upper = value_at(b + mid)
+    lower = value_at(b + np.maximum(mid - 1, 0))
+    stats[has, 2] = np.where(n % 2, upper, (lower + upper) / 2)
+    wsum = np.zeros(ngroups)
+    np.add.at(wsum, groups, values * weights)
+    stats[has, 3] = wsum[has] / n
+    stats[has, 4] = value_at(b)
+    stats[has, 5] = value_at(b + n - 1)
+    return stats
+
+def count_structures(lines, ntimes):
+    """Count the structures at every output time of consecutive simulations.
+
+    Args:
+      lines (iterable): (time index, structure, energy) for every output
+        time of every simulation, the energy may be a string.
+      ntimes (int): Number of output times per simulation.
+
+    Returns:
+      int, list, :obj:`StructureTable`: The number of complete simulations,
+      a dictionary per time index mapping the ID of every structure (in
+      order of first appearance) to [count, energy] (the last energy seen
+      for the structure, in dcal/mol) and the table of all structures.
+    """
+    counts = [dict() for _ in range(ntimes)]
+    table = StructureTable()
+    nlines = 0
+    for t, ss, en in lines:
+        k = table.intern(ss)
+        entry = counts[t].get(k)
+        if entry is None:
+            counts[t][k] = [1, en]
+        else:
+            entry[0] += 1
+            entry[1] = en
+        nlines += 1
+    for tcounts in counts:
+        for entry in tcounts.values():
+            entry[1] = int(round(float(entry[1])*100))
+    return nlines // ntimes, counts, table
+
+def count_drf_structures(drffile, times, chunksize = 1 << 10):
+    """Count the structures at every output time of a single drf file.
+
+    Trajectory files (*.drt) are expanded onto the given output times.
+    Otherwise, the file is read in chunks of chunksize simulations (i.e. chunksize
+    times len(times) lines), such that memory is bounded by the number of
+    distinct structures, independent of the number of simulations.
+
+    Args:
+      drffile (str): A *.drf file of consecutive simulations on the time grid,
+        or a *.drt trajectory file.
+      times (array): The output times of every simulation.
+      chunksize (int, optional): Number of simulations parsed at once.
+
+    Returns:
+      See :func:`count_structures`.
+    """
+    ntimes = len(times)
+    if is_drt_file(drffile):
+        return count_structures(((t, ss, en) for (_, t, ss, en) in expand_drt(drffile, times)),
+                                ntimes)
+    def lines():
+        with open(drffile) as f:
+            assert next(f, DRF_HEADER) == DRF_HEADER
+            while True:
+                chunk = list(islice(f, chunksize * ntimes))
+                if not chunk:
+                    break
+                tokens = ''.join(chunk).split()
+                tidx = np.arange(len(chunk)) % ntimes
                 # NOTE: If the line below breaks, then probably because of old
                 # data that was generated using a different t-lin and/or t-log.
-                assert np.isclose(float(time), times[t])
-                cdict[t][ss] = cdict[t].get(ss, 0) + 1
-                edict[t][ss] = int(round(float(en)*100))
-                future = '.' * (seqlen - len(ss))
-                if ss+future not in idict:
-                    idict[ss+future] = nid
-                    nid += 1
-                t += 1
-                if t == len(times):
-                    t = 0
-                    nsim += 1
-    print(f'[collecting data:] Parsed {nsim} simulations from {nfiles} files.')
+                assert np.isclose(np.array(tokens[1::5], dtype = np.float64), times[tidx]).all()
+                yield from zip(tidx.tolist(), tokens[3::5], tokens[4::5])
+    return count_structures(lines(), ntimes)
+
+def _file_stamp(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+class DrfAggregate:
+    """Structure counts per output time, merged from simulation *.drf files.
+
+    The aggregate keeps one [count, energy] counter per structure and time
+    index, the structure IDs of the combined *.drf file and a manifest of
+    all merged files. It can be saved and loaded again, such that adding
+    simulations to an existing campaign only requires to parse the new
+    files.
+
+    Args:
+      seqlen (int): Length of the full sequence.
+      times (array): The output times of every simulation.
+    """
+    def __init__(self, seqlen, times):
+        self.seqlen = seqlen
+        self.times = np.asarray(times, dtype = np.float64)
+        self.structures = StructureTable() # Structure -> index
+        # Structures are identical in the *.drf file if they only differ
+        # by trailing unpaired nucleotides.
+        self.identity = StructureTable()
+        self.sids = array('q') # Index -> ID in the *.drf file
+        self.counts = [dict() for t in range(len(times))] # Index -> [Count, Energy]
+        self.nsim = 0
+        self.files = dict() # Manifest: file -> [size, mtime] (None if never written)
+
+    def _intern_key(self, key):
+        k = self.structures.intern_key(key)
+        if k == len(self.sids):
+            self.sids.append(self.identity.intern(self.structures[k].rstrip('.')))
+        return k
+
+    def merge(self, fsim, fcounts, ftable):
+        """Merge the return value of :func:`count_structures`."""
+        self.nsim += fsim
+        kmap = [self._intern_key(ftable.key(fk)) for fk in range(len(ftable))]
+        for t, tcounts in enumerate(fcounts):
+            for fk, (count, en) in tcounts.items():
+                k = kmap[fk]
+                entry = self.counts[t].get(k)
+                if entry is None:
+                    self.counts[t][k] = [count, en]
+                else:
+                    entry[0] += count
+                    entry[1] = en
+
+    def add_files(self, drffiles, cpus = 1):
+        """Parse and merge drf files (in parallel if cpus != 1).
+
+        Returns:
+          int: The number of simulations in these files.
+        """
+        nsim = self.nsim
+        if cpus == 1 or len(drffiles) < 2:
+            for data in drffiles:
+                self.merge(*count_drf_structures(data, self.times))
+                self.files[data] = _file_stamp(data)
+        else:
+            with Pool(processes = cpus) as pool:
+                results = pool.imap(partial(count_drf_structures, times = self.times), drffiles)
+                for data, result in zip(drffiles, results):
+                    self.merge(*result)
+                    self.files[data] = _file_stamp(data)
+        return self.nsim - nsim
+
+    def is_current(self, drffiles):
+        """True if all merged files are unchanged and among drffiles.
+
+        Simulations that were merged without writing a file are ignored.
+        """
+        drffiles = set(drffiles)
+        return all(data in drffiles and os.path.exists(data) and _file_stamp(data) == stamp
+                        for data, stamp in self.files.items() if stamp is not None)
+
+    def standard_errors(self):
+        """The largest standard error of an occupancy at every output time.
+
+        The standard error of an occupancy p estimated from n simulations is
+        sqrt(p * (1 - p) / n). It is inf if there are no simulations.
+        """
+        se = np.full(len(self.times), np.inf)
+        if self.nsim:
+            for t, tcounts in enumerate(self.counts):
+                p = np.fromiter((count for (count, en) in tcounts.values()),
+                                dtype = np.float64, count = len(tcounts)) / self.nsim
+                se[t] = np.sqrt(np.max(p * (1 - p), initial = 0) / self.nsim)
+        return se
+
+    def save(self, fname):
+        """Save the aggregate into a *.npz file."""
+        tk = [(t, k) for t in range(len(self.times)) for k in self.counts[t]]
+        ce = [self.counts[t][k] for (t, k) in tk]
+        tmp = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, seqlen = self.seqlen,
+                        times = self.times,
+                        nsim = self.nsim,
+                        structures = np.array(list(self.structures), dtype = bytes),
+                        sids = np.array(self.sids, dtype = np.int64),
+                        tk = np.array(tk, dtype = np.int64).reshape(-1, 2),
+                        ce = np.array(ce, dtype = np.int64).reshape(-1, 2),
+                        manifest = json.dumps(self.files))
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Load an aggregate written by :meth:`save`."""
+        with np.load(fname) as data:
+            self = cls(int(data['seqlen']), data['times'])
+            self.nsim = int(data['nsim'])
+            for ss, ni in zip(data['structures'].tolist(), data['sids'].tolist()):
+                k = self._intern_key(pack_structure(ss.decode('ascii')))
+                assert self.sids[k] == ni
+            for (t, k), (count, en) in zip(data['tk'].tolist(), data['ce'].tolist()):
+                self.counts[t][k] = [count, en]
+            self.files = json.loads(str(data['manifest']))
+        return self
+
+    def write_kp8(self, oname):
+        """Write structures, counts and energies of the final output time."""
+        st = len(self.times)-1
+        with open(oname, 'w') as df:
+            for k, (count, en) in sorted(self.counts[st].items(), key = lambda x: x[1][1]):
+                df.write(f'{self.structures[k]} {count:>5d} {en/100:6.2f}\n')
+
+    def write_drf(self, oname, use_counts = False):
+        """Write the combined *.drf file with occupancies (or counts)."""
+        if os.path.exists(oname):
+            print(f"[WARNING:] Overwriting existing file: {oname}")
+        with open(oname, 'w') as df:
+            df.write(DRF_HEADER)
+            for t, time in enumerate(self.times):
+                for k, (count, en) in sorted(self.counts[t].items(), key = lambda x: x[1][1]):
+                    ss, ni = self.structures[k], self.sids[k]
+                    if use_counts:
+                        df.write(f'{ni:5d} {time:03.3f} {count:5d} {ss} {en/100:6.2f}\n')
+                    else:
+                        # Transform the count into an occupancy!
+                        occu = count/self.nsim
+                        df.write(f'{ni:5d} {time:03.3f} {occu:03.4f} {ss} {en/100:6.2f}\n')
+
+def load_aggregate(state, seqlen, times):
+    """Return the aggregate saved in state if it matches sequence length and
+    output times, None otherwise."""
+    if not (state and os.path.exists(state)):
+        return None
+    agg = DrfAggregate.load(state)
+    if agg.seqlen != seqlen or len(agg.times) != len(times) or not np.allclose(agg.times, times):
+        return None
+    return agg
+
+def _file_order(fname):
+    """Sort key that orders file names by their numbers, e.g. the file IDs
+    x.998.drf < x.1000.drf."""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', fname)]
+
+def update_aggregate(drffiles, seqlen, times, cpus = 1, state = None):
+    """Return the aggregate of all files that match the pattern drffiles.
+
+    Every drf (or drt) file is condensed into structure counts per time index
+    (in parallel if cpus != 1), which are merged in the order of the file IDs.
+    If the state file of a previous call exists, only the files that are not
+    yet part of it are parsed. The updated aggregate is saved in state.
+
+    If merged files have changed, the aggregate is rebuilt from the files.
+    This is refused if the aggregate contains simulations that were merged
+    without writing a file, since their counts would be lost.
+    """
+    drffiles = sorted(glob(drffiles), key = _file_order)
+    agg = load_aggregate(state, seqlen, times)
+    if agg is not None and not agg.is_current(drffiles):
+        if None in agg.files.values():
+            raise SystemExit(f'Merged files have changed, but {state} contains simulations '
+                             'without *.drf file. Restore the files or remove the state file.')
+        print(f'[WARNING:] Merged files have changed, rebuilding: {state}')
+        agg = None
+    if agg is None:
+        agg = DrfAggregate(seqlen, times)
+    new = [data for data in drffiles if data not in agg.files]
+    nsim = agg.add_files(new, cpus)
+    print(f'[collecting data:] Parsed {nsim} simulations from {len(new)} files.')
+    if state:
+        agg.save(state)
+        print(f'[collecting data:] Combined {agg.nsim} simulations from {len(agg.files)} files.')
+    return agg
+
+def combine_drfs(drffiles, oname, seqlen, times, use_counts = False, get_kp8 = False,
+                 cpus = 1, state = None):
     #
-    # Write the final vector into a separate file for potential further analysis
+    # Collect data from all drf (or drt) output files, see update_aggregate.
     #
-    if get_kp8:
-        st = len(times)-1
-        with open(f'{oname}.kp8', 'w') as df:
-            for s in sorted(edict[st], key = lambda x: edict[st][x]):
-                df.write(f'{s} {cdict[st][s]:>5d} {edict[st][s]/100:6.2f}\n')
+    agg = update_aggregate(drffiles, seqlen, times, cpus, state)
     #
-    # Transform the count dict into an occupancy dict!
+    # Write the final vector into a separate file for potential further analysis
     #
-    if use_counts:
-        odict = cdict
-    else:
-        odict = {t: dict() for t in range(len(times))} # Occupancy
-        for t in sorted(cdict):
-            for ss in cdict[t]:
-                odict[t][ss] = cdict[t][ss]/nsim
+    if get_kp8:
+        agg.write_kp8(f'{oname}.kp8')
     #
     # Write *.drf output file.
     #
-    if os.path.exists(oname):
-        print(f"[WARNING:] Overwriting existing file: {oname}")
-    with open(oname, 'w') as df:
-        df.write(f"id time occupancy structure energy\n")
-        for t in sorted(odict):
-            time = times[t]
-            for (ss, en) in sorted(edict[t].items(), key = lambda x: x[1]):
-                if ss not in odict[t]:
-                    continue
-                occu = odict[t][ss]
-                future = '.' * (seqlen - len(ss))
-                ni = idict[ss+future]
-                if use_counts:
-                    df.write(f'{ni:5d} {times[t]:03.3f} {occu:5d} {ss} {en/100:6.2f}\n')
-                else:
-                    df.write(f'{ni:5d} {times[t]:03.3f} {occu:03.4f} {ss} {en/100:6.2f}\n')
- 
+    agg.write_drf(oname, use_counts)
+    return agg
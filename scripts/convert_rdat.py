@@ -2,44 +2,21 @@
 #
 
 import sys
-import re
 import argparse
 
+from drconverters.rdat import RdatFile
 
-def rdat2csv(args, outfile):
-    annot_pat = re.compile(r"^DATA_ANNOTATION:(\d+).*datatype:REACTIVITY.*ID:Length(\d+)")
-    data_pat  = re.compile(r"^DATA:(\d+)\s+(.*)$")
-
-    with open(args.input) as f:
-        data = dict()
-        min_l = 10000
-        max_l = 0
-
-        for line in f:
-            m = annot_pat.match(line)
-            if m:
-                n = "DATA." + m.group(1)
-                l = m.group(2)
-                data[n] = {'length' : l, 'reactivities' : []}
-
-                continue
-
-            m = data_pat.match(line)
-            if m:
-                n = "DATA." + m.group(1)
-                if n in data:
-                    data[n]['reactivities'] = [float(rr) for rr in m.group(2).rstrip().split("\t") ]
 
-                continue
-
-    # re-order data
-    reactivities = { dd['length'] : dd['reactivities'] for dd in data.values() }
+def rdat2csv(args, outfile):
+    # only the requested rows are parsed from the file
+    rdat = RdatFile(args.input)
+    data = dict(rdat.rows(args.datatype, args.modifier))
 
     # determine the maximum length of the data
     if args.length > 0:
         max_l = args.length
     else:
-        max_l = max([int(n) for n in reactivities])
+        max_l = max(data)
 
     # print header line
     if args.header:
@@ -48,10 +25,10 @@ def rdat2csv(args, outfile):
         print(",".join(head_list), file=outfile)
 
     for l in range(1, max_l + 1):
-        if str(l) in reactivities:
+        if l in data:
             remaining = max_l - l
             line_list = [str(l), args.method, args.sequence_id]
-            line_list += [ str(r) for r in reactivities[str(l)]]
+            line_list += [ str(r) for r in data[l].tolist()]
             line_list += [ 'NA' for _ in range(remaining) ]
             print(",".join(line_list), file = outfile)
         else:
@@ -90,6 +67,14 @@ def main():
                         type = str,
                         help = "Method name",
                         default = "SHAPE")
+    parser.add_argument("-d", "--datatype",
+                        type = str,
+                        help = "RDAT datatype, e.g. REACTIVITY or READS",
+                        default = "REACTIVITY")
+    parser.add_argument("--modifier",
+                        type = str,
+                        help = "Modifier of the data, required for READS (e.g. BzCN or none)",
+                        default = None)
     parser.add_argument("-l", "--length",
                         type = int,
                         help = "Length of full transcript. Missing data will be filled with NA",
@@ -3,76 +3,147 @@
 import re
 import sys
 import math
-import pandas as pd
+import numpy as np
 import argparse
 
+from drconverters.drfstore import open_drf
+from drconverters.utils import weighted_stats
+
 
 def access_mode(args, outfile):
+    uprobs = get_uprobs(args.input) # uprobs[0] = []
+    print_uprobs(args, uprobs, outfile)
+
+def print_uprobs(args, uprobs, outfile):
     if args.lshape:
         assert not args.length
         assert not args.by_index
         args.length = args.lshape
         args.by_index = -1
 
-    uprobs = get_uprobs(args.input) # uprobs[0] = []
+    uprobs, seen = uprobs
     datalen = args.length + 1 if args.length else len(uprobs)
-    if args.output:
+    if args.header:
         print(f"length,method,name,{','.join(map(str, range(1, datalen)))}", file = outfile)
     if args.by_index:
         idx = args.by_index % len(uprobs)
-        data = [str(round(p, 2)) for p in uprobs[idx]] + ['NA' for _ in range(datalen - 1 - idx)]
+        data = format_uprobs(uprobs[idx], seen[idx])
+        data += ['NA' for _ in range(datalen - 1 - len(data))]
         print(f"{len(uprobs)-1},{args.method},{args.name},{','.join(data)}", file = outfile)
     else:
         for l in range(1, datalen):
-            data = [str(round(p, 2)) for p in uprobs[l]] + ['NA' for _ in range(datalen - 1 - l)]
+            data = format_uprobs(uprobs[l], seen[l]) if l < len(uprobs) else []
+            data += ['NA' for _ in range(datalen - 1 - len(data))]
             print(f"{l},{args.method},{args.name},{','.join(data)}", file = outfile)
 
+def format_uprobs(probs, seen):
+    """Format one row of the accessibilities returned by :func:`get_uprobs`.
+
+    Positions that are paired in all structures (not seen) are written as
+    "0", positions beyond the transcript length are omitted.
+    """
+    length = np.count_nonzero(~np.isnan(probs))
+    return [str(round(p, 2)) if s else '0' for p, s in
+                zip(probs[:length].tolist(), seen[:length].tolist())]
+
+def get_step_index(store):
+    """Map every line of a drf store to its transcription step.
+
+    Only the last time point of every transcript length is assigned to a step
+    (1, 2, ...), all other lines are assigned to step 0.
+    """
+    time = np.asarray(store.time)
+    length = store.lengths
+    if len(time) == 0:
+        return np.zeros(0, dtype = int)
+    new = np.ones(len(time), dtype = bool)
+    new[1:] = (time[1:] != time[:-1]) | (length[1:] != length[:-1])
+    block = np.cumsum(new) - 1
+    blen = length[new]
+    keep = np.ones(len(blen), dtype = bool)
+    keep[:-1] = blen[1:] > blen[:-1]
+    return np.where(keep, np.cumsum(keep), 0)[block]
+
+def store_uprobs(store, chunksize = 1 << 14):
+    """Occupancy-weighted accessibilities for every transcription step.
+
+    The unpaired positions are only expanded for the unique structures of
+    one chunk of lines at a time.
+
+    Returns:
+      numpy.ndarray, numpy.ndarray: A (steps x max. length) matrix, where
+      row 0 is empty and positions beyond the transcript length of a step
+      are NaN, and a boolean matrix that is False for positions that are
+      paired in every structure of a step.
+    """
+    step = get_step_index(store)
+    nsteps = step.max() + 1 if len(step) else 1
+    lines = np.flatnonzero(step)
+    width = int(store.lengths[lines].max()) if len(lines) else 0
+    uprobs = np.zeros((nsteps, width))
+    seen = np.zeros((nsteps, width), dtype = bool)
+    for lo in range(0, len(lines), chunksize):
+        idx = lines[lo:lo + chunksize]
+        ks, inv = np.unique(store.structure[idx], return_inverse = True)
+        up = (store.ss_matrix(ks) == ord('.'))[inv.ravel()]
+        w = up.shape[1]
+        # NOTE: ufunc.at adds one line after the other, i.e. in the same order
+        # as a line-by-line parser would do.
+        np.add.at(uprobs[:, :w], step[idx], store.occupancy[idx][:, None] * up)
+        np.logical_or.at(seen[:, :w], step[idx], up)
+    steplen = np.zeros(nsteps, dtype = int)
+    steplen[step[lines]] = store.lengths[lines]
+    uprobs[np.arange(width) >= steplen[:, None]] = np.nan
+    return uprobs, seen
+
+def store_energies(store):
+    """Occupancy-weighted energies for every transcription step.
+
+    Occupancies are converted to integer weights in units of 1e-4, lines with
+    weight 0 are ignored.
+
+    Returns:
+      (int, numpy.ndarray, numpy.ndarray, numpy.ndarray): The number of steps
+      (including the empty step 0), and the step, energy and weight of every
+      distinct energy per step.
+    """
+    step = get_step_index(store)
+    nsteps = step.max() + 1 if len(step) else 1
+    weight = np.minimum(np.round(np.asarray(store.occupancy) * 10000).astype(np.int64), 10000)
+    assert np.all(weight >= 0)
+    lines = np.flatnonzero((step > 0) & (weight > 0))
+    step, energy, weight = step[lines], np.asarray(store.energy)[lines], weight[lines]
+    order = np.lexsort((energy, step))
+    step, energy, weight = step[order], energy[order], weight[order]
+    new = np.ones(len(step), dtype = bool)
+    new[1:] = (step[1:] != step[:-1]) | (energy[1:] != energy[:-1])
+    first = np.flatnonzero(new)
+    return nsteps, step[first], energy[first], np.add.reduceat(weight, first) if len(first) else weight
+
 def drtrafo_get_drforna_energies(drf):
-    bins = []
-    with open(drf) as f:
-        last_time = 0
-        last_step = 0
-        last_bin = {}
-        for e, line in enumerate(f):
-            if e == 0:
-                assert line == "id time occupancy structure energy\n"
-                continue
-
-            [_, time, occ, ss, en] = line.split()
-            occ = min(int(round(float(occ)*10000)), 10000)
-            assert 0 <= occ <= 10000
-            en = float(en)
-            # assert en <= 0
-
-            if occ == 0 : 
-                continue
-
-            step = len(ss)
-            if time == last_time and step == last_step:
-                # let's add occuancy to last-time bin and continue
-                if en in last_bin:
-                    last_bin[en] += occ
-                else:
-                    last_bin[en] = occ
-                continue
-
-            elif step > last_step:
-                # yes, let's push the last bin
-                bins.append(last_bin.copy())
-
-            # else, initialize a new bin
-            last_time = time
-            last_step = step
-            last_bin = {}
-            last_bin[en] = occ
-        # let's push the last bin
-        bins.append(last_bin.copy())
-    return bins
+    return store_energies(open_drf(drf))
+
+def get_uprobs(drf):
+    return store_uprobs(open_drf(drf))
+
+def get_energies_and_uprobs(drf):
+    """Energy bins and accessibilities from one read of a drf file.
+
+    A text *.drf file is parsed into memory once (see :func:`open_drf`) and
+    both statistics are computed from the same store, a drf store is
+    memory-mapped.
+    """
+    store = open_drf(drf)
+    return store_energies(store), store_uprobs(store)
 
 def energy_mode(args, outfile):
-        eranges = drtrafo_get_drforna_energies(args.input)
-        datalen = args.length + 1 if args.length else len(eranges)
-        if args.output:
+    eranges = drtrafo_get_drforna_energies(args.input)
+    print_energies(args, eranges, outfile)
+
+def print_energies(args, eranges, outfile):
+        nsteps, steps, energies, weights = eranges
+        datalen = args.length + 1 if args.length else nsteps
+        if args.header:
             header_list = ["length",
                            "method",
                            "name",
@@ -84,51 +155,18 @@ def energy_mode(args, outfile):
                            "Qmax"]
             print(",".join(header_list), file = outfile)
 
+        stats = weighted_stats(steps, energies, weights, max(datalen, nsteps))
         for l in range(1, datalen):
-            # Expand energy counts to list
-            energies = []
-            for key in eranges[l]:
-                energies = energies + [float(key) for _ in range(0, eranges[l][key])]
-            df  = pd.Series(energies)
-            qt  = df.quantile([0.25,0.75])
-            data_list = [f'{l:d}',
-                         f'{args.method}',
-                         f'{args.name}',
-                         f'{qt[0.25]:.2f}',
-                         f'{qt[0.75]:.2f}',
-                         f'{df.median():.2f}',
-                         f'{df.mean():.2f}',
-                         f'{df.min():.2f}',
-                         f'{df.max():.2f}']
+            data_list = [f'{l:d}', f'{args.method}', f'{args.name}']
+            data_list += [f'{d:.2f}' for d in stats[l]]
             print(",".join(data_list), file=outfile)
 
 
-def get_uprobs(drf):
-    uprobs = []
-    with open(drf) as f:
-        llen, ltime, lltime = 0, '0', '0'
-        up = []
-        for i, line in enumerate(f):
-            if i == 0:
-                assert line == "id time occupancy structure energy\n"
-                continue
-            [_, stime, occ, ss, en] = line.split()
-            occu = float(occ)
-            if ltime == stime and len(ss) == llen:
-                for j, b in enumerate(ss):
-                     if b == '.': 
-                         up[j] += occu
-            else:
-                if len(ss) > llen:
-                    uprobs.append(up)
-                up = [0 for _ in range(len(ss))]
-                for j, b in enumerate(ss):
-                     if b == '.': 
-                         up[j] += occu
-            llen = len(ss)
-            ltime = stime
-        uprobs.append(up)
-    return uprobs
+def all_mode(args, outfiles):
+    eranges, uprobs = get_energies_and_uprobs(args.input)
+    efile, ufile = outfiles
+    print_energies(args, eranges, efile)
+    print_uprobs(args, uprobs, ufile)
 
 def main():
     """ drf_parser.py
@@ -144,10 +182,19 @@ def main():
 
     parser.add_argument("-l", "--length", type = int,
                         help = "Specify transcript length (e.g. when data is missing).")
-    parser.add_argument("-n", "--name", type = str, required = True,
-                        help = "Sequence name")
-    parser.add_argument("-m", "--method", type = str, required = True,
-                        help = "Method name")
+    parser.add_argument("-n", "--name", type = str, required = True, action = "append",
+                        help = """Sequence name. Repeat the option to specify one
+                        name per input file.""")
+    parser.add_argument("-m", "--method", type = str, required = True, action = "append",
+                        help = """Method name. Repeat the option to specify one
+                        method per input file.""")
+
+    # positional input arguments are shared by all sub-commands
+    inputs = argparse.ArgumentParser(add_help = False)
+    inputs.add_argument('input', nargs = '+',
+                        help = """Path to the input file(s) (*.drf or drf store).
+                        Multiple files are processed one after another and
+                        written into the same output.""")
 
     # create sub-parsers for the different modes of this script
     sub_parsers = parser.add_subparsers(title = 'subcommands',
@@ -155,12 +202,12 @@ def main():
                                         required = True)
 
     # options for the 'energy distribution' mode
-    parser_en = sub_parsers.add_parser('energy',
+    parser_en = sub_parsers.add_parser('energy', parents = [inputs],
                                        help='Extract energy distribution mode.')
     parser_en.set_defaults(func = energy_mode)
 
     # options for the 'accessibility profile' mode
-    parser_up = sub_parsers.add_parser('accessibility',
+    parser_up = sub_parsers.add_parser('accessibility', parents = [inputs],
                                        help = 'Extract accessibilies mode.')
     parser_up.add_argument("--by-index", type = int, default = 0,
                         help = "Get accessibilities from specific step.")
@@ -171,19 +218,56 @@ def main():
     # no further options for this mode (yet)
     parser_up.set_defaults(func = access_mode)
 
+    # options for the combined 'energy distribution + accessibility profile' mode
+    parser_all = sub_parsers.add_parser('all', parents = [inputs],
+                                        help = """Extract energy distributions and
+                                        accessibilities, reading the input only once (text
+                                        *.drf files are loaded into memory, convert large
+                                        files with DrfStore first). Requires -o/-a,
+                                        which is used as prefix for the output files
+                                        <prefix>.energy.csv and <prefix>.accessibility.csv.""")
+    parser_all.add_argument("--by-index", type = int, default = 0,
+                        help = "Get accessibilities from specific step.")
+    parser_all.add_argument("--lshape", type = int,
+                        help = "Shortcut to read results of a shapeseq simulation.")
+    parser_all.set_defaults(func = all_mode)
 
-    parser.add_argument('input', default=None, help="Path to the input file.")
     args = parser.parse_args()
 
-    outfile = sys.stdout
-    if args.output:
-        outfile = open(args.output, "w")
-    elif args.append:
-        outfile = open(args.append, "a")
+    # assign method and sequence names to every input file
+    nin = len(args.input)
+    for opt in ('name', 'method'):
+        values = getattr(args, opt)
+        if len(values) == 1:
+            values *= nin
+        elif len(values) != nin:
+            parser.error(f"Number of --{opt} options must be 1 or match the number of input files.")
+        setattr(args, opt, values)
+
+    if args.func is all_mode:
+        if not (args.output or args.append):
+            parser.error("Subcommand 'all' requires -o/--output or -a/--append.")
+        prefix = args.output or args.append
+        fmode = "w" if args.output else "a"
+        outfile = (open(f"{prefix}.energy.csv", fmode),
+                   open(f"{prefix}.accessibility.csv", fmode))
+    else:
+        outfile = sys.stdout
+        if args.output:
+            outfile = open(args.output, "w")
+        elif args.append:
+            outfile = open(args.append, "a")
 
-    args.func(args, outfile)
+    for e, (drf, method, name) in enumerate(zip(args.input, args.method, args.name)):
+        job = argparse.Namespace(**vars(args))
+        job.input, job.method, job.name = drf, method, name
+        job.header = bool(args.output) and e == 0
+        args.func(job, outfile)
 
-    if args.output or args.append:
+    if args.func is all_mode:
+        for f in outfile:
+            f.close()
+    elif args.output or args.append:
         outfile.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+
+import sys
+import argparse
+import numpy as np
+
+from drconverters.rdat import RdatFile, merge_replicates
+
+
+STATISTICS = ("mean", "sd", "weighted")
+
+
+def replicates2csv(args, outfile):
+    rdats = [RdatFile(f) for f in args.input]
+    lengths, stats = merge_replicates(rdats)
+
+    # determine the maximum length of the data
+    if args.length > 0:
+        max_l = args.length
+    else:
+        max_l = int(lengths.max())
+
+    # print header line
+    if args.header:
+        head_list = ["length", "method", "name"]
+        head_list += [str(i) for i in range(1, max_l + 1) ]
+        print(",".join(head_list), file=outfile)
+
+    rows = {l : k for k, l in enumerate(lengths.tolist())}
+    for stat in STATISTICS:
+        method = f"{args.method}-{stat}"
+        for l in range(1, max_l + 1):
+            line_list = [str(l), method, args.sequence_id]
+            if l in rows:
+                values = stats[stat][rows[l], :max_l].tolist()
+                values += [np.nan for _ in range(max_l - len(values))]
+                line_list += [ "{:g}".format(v) if not np.isnan(v) else "NA" for v in values ]
+            else:
+                line_list += [ 'NA' for _ in range(max_l) ]
+            print(",".join(line_list), file = outfile)
+
+
+def replicates2npz(args, outfile):
+    rdats = [RdatFile(f) for f in args.input]
+    lengths, stats = merge_replicates(rdats)
+    np.savez(outfile, lengths = lengths, **stats)
+
+
+def main():
+    outfile       = None
+    parser        = argparse.ArgumentParser(
+        description = """Merge replicate RDAT files into one CSV file with the mean,
+        standard deviation and read-weighted mean reactivity of every length and
+        position. The method column is <method>-mean, <method>-sd and
+        <method>-weighted, respectively. Output files ending in .npz store the
+        lengths and the matrices mean, sd and weighted instead.""")
+    group_header  = parser.add_mutually_exclusive_group()
+
+    parser.add_argument("input",
+                        type = str,
+                        nargs = "+",
+                        help = "Replicate RDAT files of the same sequence.")
+    parser.add_argument("-o", "--output",
+                        type = str,
+                        help = "Output file name. Defaults to print to stdout.",
+                        default = None)
+    group_header.add_argument("--header",
+                        action="store_true",
+                        help="Add header line")
+    group_header.add_argument("--no-header",
+                        action = "store_true",
+                        help = "Do not add header line.")
+    parser.add_argument("-s", "--sequence-id",
+                        type = str,
+                        help = "Sequence identifier",
+                        default = "RNA")
+    parser.add_argument("-m", "--method",
+                        type = str,
+                        help = "Method name",
+                        default = "SHAPE")
+    parser.add_argument("-l", "--length",
+                        type = int,
+                        help = "Length of full transcript. Missing data will be filled with NA",
+                        default = -1)
+
+    args = parser.parse_args()
+
+    if not args.no_header:
+        args.header = True
+
+    if args.output and args.output.endswith(".npz"):
+        replicates2npz(args, args.output)
+        return
+
+    # prepare output stream
+    outfile = open(args.output, "w") if args.output else sys.stdout
+
+    replicates2csv(args, outfile)
+
+
+if __name__ == '__main__':
+    main()
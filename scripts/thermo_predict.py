@@ -1,11 +1,23 @@
 #!/usr/bin/python
 #
+import io
+import os
 import sys
 import csv
+import glob
+import json
+import hashlib
 import argparse
 import re
 import RNA
-import pandas as pd
+import numpy as np
+from itertools import product
+from collections import Counter
+from multiprocessing import Pool
+
+from drconverters.utils import weighted_stats
+from drconverters.prefixcache import PrefixCache, array_digest, file_digest, md_digest
+from drconverters.rdat import RdatFile, length_matrix
 
 
 def get_sequence_line(filename):
@@ -15,127 +27,640 @@ def get_sequence_line(filename):
     such line is found or there is any problem
     with the input file, return None
     """
-    sequence = None
-    header   = None
+    return next(get_sequences(filename), (None, None))
+
 
+def get_sequences(filename):
+    """
+    Yield (sequence, header) for every FASTA entry of a file. For
+    input without FASTA header, each sequence must be on a single line
+    and is yielded with header None. If filename is a directory, all
+    FASTA files (*.fa, *.fasta) in this directory are read.
+    """
     seq_pattern       = re.compile(r"([ACGUTNacgutn]+)")
     fasta_header_pat  = re.compile(r"^>\s*([^\s]+)")
 
-    with open(filename) as f:
-        for line in f:
-            m = fasta_header_pat.match(line)
-            if m:
-                # only process first FASTA entry in file
-                if header and sequence:
-                    return (sequence, header)
+    if os.path.isdir(filename):
+        files = sorted(glob.glob(os.path.join(filename, "*.fa")) +
+                       glob.glob(os.path.join(filename, "*.fasta")))
+    else:
+        files = [filename]
+
+    for fname in files:
+        sequence = None
+        header   = None
+        with open(fname) as f:
+            for line in f:
+                m = fasta_header_pat.match(line)
+                if m:
+                    if header and sequence:
+                        yield (sequence, header)
+
+                    header    = m.group(1)
+                    sequence  = ""
+                    continue
+
+                m = seq_pattern.match(line)
+                if m:
+                    # for input without FASTA header, each
+                    # sequence must be on a single line
+                    if not header:
+                        yield (m.group(1), None)
+                    else:
+                        sequence += m.group(1)
+
+        if header and sequence:
+            yield (sequence, header)
+
+
+# SHAPE data matrices, loaded once per process
+_SHAPE_data = {}
+
+def get_SHAPE_data(filename, n, offset = 14, method = None, sequence = None):
+    """
+    Return the SHAPE reactivities of all nascent transcripts as NumPy
+    matrix, where row i is the reactivity vector of the transcript of
+    length i (entry 0 is unused) and missing data is -999. The matrix
+    is read only once per process.
+
+    The file may be an RDAT file (aligned by OFFSET and SEQPOS), a NumPy
+    *.npz file or a csv file, see read_SHAPE_data().
+    """
+    stat = os.stat(filename)
+    key  = (filename, stat.st_size, stat.st_mtime_ns, n, offset, method)
+    if key not in _SHAPE_data:
+        _SHAPE_data[key] = read_SHAPE_data(filename, n, offset, method, sequence)
+    return _SHAPE_data[key]
+
+
+def read_SHAPE_data(filename, n, offset = 14, method = None, sequence = None):
+    """
+    Read SHAPE reactivities for all transcript lengths up to n. The data of
+    transcript length l + offset is used for the nascent transcript of
+    length l (by default 14 nucleotides, which are still bound by the
+    polymerase and cannot fold).
+
+    RDAT files: the REACTIVITY rows, where the nucleotide of every data column
+    is SEQPOS - OFFSET. If sequence is given, it is compared to the RDAT
+    SEQUENCE. Only the rows of lengths up to n are parsed.
+
+    *.npz files: an array 'lengths' and (lengths x positions) matrices, where
+    column j is nucleotide j+1 (e.g. written by merge_replicates.py). method
+    selects the matrix, by default the first one.
+
+    csv files: files with a length,method,name,1,2,... header (as written by
+    convert_rdat.py and merge_replicates.py) are indexed by transcript
+    length. Only the rows of the given method (by default the first method
+    in the file) are used. In files without this header, every row is the
+    length followed by reactivities.
+    """
+    with open(filename, "rb") as f:
+        is_rdat = f.read(12) == b"RDAT_VERSION"
+
+    if is_rdat:
+        rdat = RdatFile(filename)
+        if sequence and rdat.sequence:
+            rseq = rdat.sequence.upper().replace("T", "U")[:len(sequence)]
+            if rseq != sequence.upper().replace("T", "U")[:len(rseq)]:
+                print(f"WARNING: The sequence in {filename} differs from the input sequence.",
+                      file=sys.stderr)
+        lengths = [l for l in rdat.lengths() if offset < l <= n + offset]
+        lengths, data = rdat.reactivities(lengths)
+        SHAPE_data = length_matrix(lengths - offset, data, n, rdat.positions())
+    elif filename.endswith(".npz"):
+        with np.load(filename) as data:
+            method = method if method else [k for k in data.files if k != "lengths"][0]
+            SHAPE_data = length_matrix(data["lengths"] - offset, data[method], n)
+    else:
+        with open(filename, "r") as f:
+            reader = csv.reader(f)
+            header = next(reader, None) # skip header
+            named  = bool(header) and header[:3] == ["length", "method", "name"]
+            lengths, rows = [], []
+            for row in reader:
+                if named:
+                    if method is None:
+                        method = row[1]
+                    if row[1] != method:
+                        continue
+                if offset < int(row[0]) <= n + offset:
+                    lengths.append(int(row[0]))
+                    values = row[3:n + 3] if named else row[1:n + 1]
+                    rows.append([ float(d) if d != "NA" else np.nan for d in values ])
+        width = max(map(len, rows), default = 0)
+        data = np.full((len(rows), width), np.nan)
+        for k, row in enumerate(rows):
+            data[k, :len(row)] = row
+        SHAPE_data = length_matrix(np.array(lengths, dtype = np.int64) - offset, data, n)
+
+    return np.where(np.isnan(SHAPE_data), -999., SHAPE_data)
+
+
+# Deigan et al. pseudo-energies, computed once per process
+_SHAPE_energies = {}
+
+def get_SHAPE_energies(args, n, sequence = None):
+    """
+    Return the SHAPE pseudo-energies of all nascent transcripts as NumPy
+    matrix (row i for the transcript of length i, see get_SHAPE_data), or
+    None without --SHAPE. The pseudo-energy of nucleotide i with reactivity
+    r is m * ln(r + 1) + b for every stacked pair it is part of, missing
+    data (r < 0) does not contribute. If sequence is given, it is compared
+    to the sequence of an RDAT file.
+    """
+    if not getattr(args, "SHAPE", None):
+        return None
+    stat = os.stat(args.SHAPE)
+    key  = (args.SHAPE, stat.st_size, stat.st_mtime_ns, n, args.offset, args.SHAPE_method,
+            args.SHAPE_slope, args.SHAPE_intercept)
+    if key not in _SHAPE_energies:
+        data = get_SHAPE_data(args.SHAPE, n, args.offset, args.SHAPE_method, sequence)
+        _SHAPE_energies[key] = np.where(data >= 0,
+                    args.SHAPE_slope * np.log(np.maximum(data, 0) + 1) + args.SHAPE_intercept, 0.)
+    return _SHAPE_energies[key]
+
+
+def get_SHAPE_constraints(args, l, sequence):
+    """
+    Return the SHAPE pseudo-energies of the nascent transcript of length l
+    (entry 0 is unused), or None if there is no SHAPE data for this length
+    """
+    energies = get_SHAPE_energies(args, len(sequence))
+    if energies is None or l >= len(energies) or not energies[l, 1:l + 1].any():
+        return None
+    return energies[l, :l + 1]
+
+
+def get_accessibilities(fc, n):
+    """
+    Return the probabilities to be unpaired for positions 1 to n
+    after the partition function of fold compound fc has been computed
+    """
+    # base pair probabilities P[i][j] for i < j (upper triangle)
+    P = np.array(fc.bpp())[1:n + 1, 1:n + 1]
+    # position k is paired with i < k (column k) or with j > k (row k),
+    # reducing along axis 0 sums up the pairing partners in sequence order
+    return 1 - np.add.reduce(P + P.T, axis = 0)
+
+
+# energy parameter file loaded in this process (None = default parameters)
+_params = None
+
+def set_energy_model(params, temperature):
+    """
+    Load an energy parameter file (or the default parameters if params is
+    None) unless it is already loaded, and set the folding temperature
+    """
+    global _params
+    if params != _params:
+        if params:
+            RNA.read_parameter_file(params)
+        else:
+            RNA.params_load_RNA_Turner2004()
+        _params = params
+        # ViennaRNA re-uses the (Boltzmann scaled) energy parameters of the
+        # last fold compound unless the model details change, fold once with
+        # different model details to replace them
+        md = RNA.md()
+        md.temperature += 1
+        fc = RNA.fold_compound("GGGAAACCC", md)
+        fc.mfe()
+        fc.pf()
+    RNA.cvar.temperature = temperature
+
+
+def init_worker(params, temperature):
+    """
+    Prepare a worker process of the folding pool
+    """
+    # load energy parameters if necessary
+    set_energy_model(params, temperature)
+    # do not draw the same Boltzmann samples in all worker processes
+    RNA.init_rand(int.from_bytes(os.urandom(4), "little"))
+
+
+def pool_size(jobs, ntasks):
+    """
+    Return the number of worker processes for ntasks tasks and the --jobs
+    option (0 = all cpus): at most one per cpu and task, additional workers
+    only add their startup cost
+    """
+    cpus = os.cpu_count() or 1
+    return max(1, min(jobs if jobs > 0 else cpus, cpus, ntasks))
+
+
+def map_lengths(func, args, lengths, *fargs):
+    """
+    Yield func(args, l, *fargs) for all transcript lengths l in the
+    order of lengths. With more than one worker (see pool_size), the
+    lengths are distributed to a pool of worker processes, where the
+    largest (i.e. most expensive) lengths are scheduled first. Worker
+    processes inherit the data computed before (e.g. the full-length
+    partition function and the SHAPE pseudo-energies).
+    """
+    lengths = list(lengths)
+    jobs    = pool_size(args.jobs, len(lengths))
+    if jobs == 1:
+        for l in lengths:
+            yield func(args, l, *fargs)
+        return
+
+    with Pool(processes = jobs,
+              initializer = init_worker,
+              initargs = (args.params, args.temperature)) as pool:
+        results = { l : pool.apply_async(func, (args, l) + fargs)
+                        for l in sorted(lengths, reverse = True) }
+        for l in lengths:
+            yield results[l].get()
+
+
+def fold_prefix(subseq, md = None, sc = None):
+    """
+    Fold a nascent transcript, return the fold compound with computed
+    partition function and base pair probabilities, the MFE and the
+    ensemble free energy. Optionally, sc are the SHAPE pseudo-energies
+    of the transcript (see get_SHAPE_constraints).
+    """
+    # create fold_compound for subsequence
+    fc  = RNA.fold_compound(subseq, md) if md else RNA.fold_compound(subseq)
+    if sc is not None:
+        fc.sc_set_stack(sc)
+    # compute MFE
+    (ss, mfe) = fc.mfe()
+    # rescale Boltzmann factors
+    fc.exp_params_rescale(mfe)
+    # compute partition function and base pair probabilities
+    (pss, ens) = fc.pf()
+    return fc, mfe, ens
+
 
-                header    = m.group(1)
-                sequence  = ""
-                continue
+# --cache directories, opened once per process
+_caches = {}
+
+def get_cache(args):
+    """
+    Return the PrefixCache of the --cache option (or None)
+    """
+    if not args.cache:
+        return None
+    if args.cache not in _caches:
+        _caches[args.cache] = PrefixCache(args.cache, args.cache_size * 2**20)
+    return _caches[args.cache]
 
-            m = seq_pattern.match(line)
-            if m:
-                # for input without FASTA header, each
-                # sequence must be on a single line
-                if not header:
-                    return (m.group(1), None)
-                elif sequence:
-                    sequence += m.group(1)
-                else:
-                    sequence = m.group(1)
 
-    return (sequence, header)
+def prefix_ensemble(args, subseq, md = None, folded = None, sc = None):
+    """
+    Return MFE, ensemble free energy, probabilities to be unpaired and the
+    mean base pair distance of a nascent transcript. Results are looked up
+    in (and added to) the --cache directory if available. Optionally,
+    folded is the return value of fold_prefix(subseq, md, sc).
+    """
+    cache = get_cache(args)
+    if cache:
+        key = cache.key(subseq,
+                        args.params_digest,
+                        md_digest(md if md else RNA.md()),
+                        array_digest(sc))
+        if folded is None:
+            props = cache.get(key)
+            if props is not None:
+                return props
 
+    fc, mfe, ens = folded if folded else fold_prefix(subseq, md, sc)
+    props = { "mfe"      : np.float64(mfe),
+              "ensemble" : np.float64(ens),
+              "unpaired" : get_accessibilities(fc, len(subseq)),
+              "mbpd"     : np.float64(fc.mean_bp_distance()) }
+    if cache:
+        cache.put(key, **props)
+    return props
 
-def get_SHAPE_data(filename, n, offset = 14):
+
+def window_probabilities(args, subseq):
     """
-    Read csv separated SHAPE data from a file and return it
-    as list of lists of SAHPE reactivities
+    Compute local (plfold-style) pair probabilities of subseq with window
+    size args.window and maximal base pair span args.max_span. Return the
+    probabilities to be unpaired and, for every position i, the sum of
+    p_ij * (1 - p_ij) over all pairs (i, j) with j > i
     """
-    SHAPE_data  = []
+    n   = len(subseq)
+    md  = RNA.md()
+    md.window_size = min(args.window, n)
+    md.max_bp_span = min(args.max_span, md.window_size)
+
+    fc        = RNA.fold_compound(subseq, md, RNA.OPTION_WINDOW)
+    unpaired  = np.zeros(n)
+    div       = np.zeros(n)
 
-    with open(filename, "r") as f:
-        reader = csv.reader(f)
-        next(reader, None) # skip header
-        for row in reader:
-            i   = int(row[0])
-            dat = [-999.] + [ float(d) if d != "NA" else -999. for d in row[1:] ]
-            if i > offset:
-                if i - offset - 1 > len(SHAPE_data):
-                    SHAPE_data += [ [-999.0 for j in range(0, n + 1) ] for k in range(i - offset - len(SHAPE_data)) ]
-                SHAPE_data.append(dat)
+    def collect(v, v_size, i, maxsize, what, data):
+        if what & RNA.PROBS_WINDOW_UP:
+            unpaired[i - 1] = v[1]
+        elif what & RNA.PROBS_WINDOW_BPP:
+            # v[j] is the probability of pair (i, j), only set for j > i
+            p = np.array(v[i + 1 : v_size + 1], dtype = np.float64)
+            div[i - 1] = np.dot(p, 1 - p)
 
-    return SHAPE_data
+    fc.probs_window(1, RNA.PROBS_WINDOW_BPP | RNA.PROBS_WINDOW_UP, collect)
+    return unpaired, div
+
+
+def local_prefix_ensemble(args, l, sequence, local):
+    """
+    Return the local probabilities to be unpaired and the mean base pair
+    distance of the nascent transcript of length l, where local is the
+    return value of window_probabilities(args, sequence).
+
+    A base pair (i, j) is only part of windows [k, k + W - 1] with
+    j - W < k <= i, hence, local probabilities of positions up to
+    l - W are identical in the transcript of length l and in the full
+    sequence. Only the remaining tail is re-computed from the last
+    2W nucleotides of the transcript.
+    """
+    subseq = sequence[0:l]
+    cache  = get_cache(args)
+    if cache:
+        key = cache.key(subseq,
+                        args.params_digest,
+                        {"window" : args.window, "max_span" : args.max_span},
+                        None) # SHAPE data
+        props = cache.get(key)
+        if props is not None:
+            return props
+
+    k  = max(0, l - args.window)
+    lo = max(0, l - 2 * args.window)
+    (up_tail, div_tail) = window_probabilities(args, subseq[lo:])
+    (up_full, div_full) = local
+
+    props = { "unpaired" : np.concatenate([up_full[:k], up_tail[k - lo:]]),
+              "mbpd"     : np.float64(2 * (div_full[:k].sum() + div_tail[k - lo:].sum())) }
+    if cache:
+        cache.put(key, **props)
+    return props
+
+
+def accessibility_line(args, l, sequence, local = None):
+    """
+    Predict the accessibility profile of the nascent transcript of length l
+    """
+    if local is not None:
+        props = local_prefix_ensemble(args, l, sequence, local)
+    else:
+        props = prefix_ensemble(args, sequence[0:l], sc = get_SHAPE_constraints(args, l, sequence))
+    # collect data for current line of accessibilities
+    line_list = [str(l), "equilibrium", args.sequence_id]
+    line_list += [ "{:g}".format(p) for p in props["unpaired"].tolist() ]
+    line_list += [ "NA" for i in range(l + 1, len(sequence) + 1) ]
+    return ",".join(line_list)
 
 
 def accessibility(args, sequence, outfile):
     """
     Predict accessibility profiles
     """
+    n = len(sequence)
+    get_SHAPE_energies(args, n, sequence)
+
     # print header line
     if args.header:
         head_list = ["length", "method", "name"]
         head_list += [str(i) for i in range(1, n + 1) ]
         print(",".join(head_list), file=outfile)
 
+    # local pair probabilities of the full sequence
+    local = window_probabilities(args, sequence) if args.window else None
+
     # loop over all nascent transcripts
-    for l in range(1, len(sequence) + 1):
-        # create fold_compound for subsequence
-        fc  = RNA.fold_compound(sequence[0:l])
-        # compute MFE
-        (ss, mfe) = fc.mfe()
-        # rescale Boltzmann factors
-        fc.exp_params_rescale(mfe)
-        # compute partition function and base pair probabilities
-        fc.pf()
-        # retrieve base pair probabilities
-        bpp = fc.bpp()
-        # initialize list for accessibilities
-        q = [ 0 for i in range(0, l + 1) ]
-        # sum-up probabilities to be paired
-        for i in range(1, l + 1):
-            for j in range(i, l + 1):
-                q[i] += bpp[i][j]
-                q[j] += bpp[i][j]
-        # turn probabilities to be paired into actual accessibilities
-        for i in range(1, l + 1):
-            q[i] = 1 - q[i]
-        # collect data for current line of accessibilities
-        line_list = [str(l), "equilibrium", args.sequence_id]
-        line_list += [ "{:g}".format(q[i]) for i in range(1, l + 1) ]
-        line_list += [ "NA" for i in range(l + 1, len(sequence) + 1) ]
+    for line in map_lengths(accessibility_line, args, range(1, n + 1), sequence, local):
         # print accessibilities
-        print(",".join(line_list), file=outfile)
+        print(line, file=outfile)
+
+
+def diversity_line(args, l, sequence, local = None):
+    """
+    Predict the ensemble diversity of the nascent transcript of length l
+    """
+    if local is not None:
+        props = local_prefix_ensemble(args, l, sequence, local)
+    else:
+        props = prefix_ensemble(args, sequence[0:l], sc = get_SHAPE_constraints(args, l, sequence))
+
+    line = [str(l), args.sequence_id, "{:g}".format(props["mbpd"]/l)]
+    return ",".join(line)
 
-    if outfile != sys.stdout:
-        outfile.close()
 
 def diversity(args, sequence, outfile):
     """
     Predict ensemble diversity profiles
     """
+    get_SHAPE_energies(args, len(sequence), sequence)
+
     # print header line
     if args.header:
         head_list = ["length", "name", "div"]
         print(",".join(head_list), file=outfile)
 
+    # local pair probabilities of the full sequence
+    local = window_probabilities(args, sequence) if args.window else None
+
     # loop over all nascent transcripts
-    for l in range(1, len(sequence) + 1):
-        # create fold_compound for subsequence
-        fc  = RNA.fold_compound(sequence[0:l])
-        # compute MFE
-        (ss, mfe) = fc.mfe()
-        # rescale Boltzmann factors
+    for line in map_lengths(diversity_line, args, range(1, len(sequence) + 1), sequence, local):
+        # print ensemble diversity
+        print(line, file=outfile)
+
+
+# partition function of the full-length sequence, computed once per process
+_full_fc = {}
+
+def get_full_fc(sequence, md):
+    """
+    Return a fold compound for the full sequence with computed partition function
+    """
+    if sequence not in _full_fc:
+        fc      = RNA.fold_compound(sequence, md)
+        ss, mfe = fc.mfe()
+
         fc.exp_params_rescale(mfe)
-        # compute partition function and base pair probabilities
         fc.pf()
+        _full_fc[sequence] = fc
+    return _full_fc[sequence]
+
+
+def energy_lines(args, i, sequence):
+    """
+    Compute MFE and obtain Boltzmann samples for the nascent transcript of length i
+    """
+    md          = RNA.md()
+    md.uniq_ML  = 1
+
+    subseq    = sequence[0 : i]
+    mfe       = None
+
+    if args.exact:
+        mfe, stats = exact_energies(subseq, md, args.band)
+        return format_energy_lines(args, i, stats, None, mfe, method = "exact")
+
+    if args.SHAPE:
+        fc_sub = RNA.fold_compound(subseq, md)
+        # unconstrained MFE, also used to rescale Boltzmann factors
+        (ss, mfe) = fc_sub.mfe()
+        sc = get_SHAPE_constraints(args, i, sequence)
+        if sc is not None:
+            fc_sub.sc_set_stack(sc)
+        fc_sub.exp_params_rescale(mfe)
+        fc_sub.pf()
+    else:
+        fc_sub = get_full_fc(sequence, md)
+        if args.mfe:
+            (ss, mfe) = RNA.fold(subseq)
+
+    energies, counts = sample_energies(fc_sub, subseq, args.samples)
+
+    return format_energy_lines(args, i, energies, counts, mfe)
+
+
+def log_partition_function(subseq, md, mfe, beta_scale = 1., fc = None):
+    """
+    Return the natural logarithm of the partition function of subseq and the
+    thermal energy kT (in kcal/mol) for the Boltzmann factors scaled by beta_scale.
+    An existing fold compound fc of subseq with the same model details (and
+    beta_scale) is reused
+    """
+    if fc is None:
+        # the fold compound keeps its own copy of the model details
+        default       = md.betaScale
+        md.betaScale  = beta_scale
+        fc            = RNA.fold_compound(subseq, md)
+        md.betaScale  = default
+    fc.exp_params_rescale(mfe)
+    fc.pf()
+    # the ensemble free energy returned by pf() is single precision,
+    # get ln(Z) from the scaled partition function in double precision
+    n = len(subseq)
+    lnZ = np.log(fc.exp_matrices.q1k[n]) - np.log(fc.exp_matrices.scale[n])
+    return lnZ, fc.exp_params.kT / 1000.
+
+
+def energy_moments(subseq, md, mfe, lnZ, kT, h = 1e-4):
+    """
+    Return the Boltzmann weighted mean and variance of the free energies of
+    all structures of subseq, i.e. the first and second derivative of ln(Z)
+    with respect to the inverse thermal energy beta, computed as central
+    differences around ln(Z) and kT of the unscaled ensemble, which requires
+    two more partition functions
+    """
+    (lnZ_lo, kT_lo) = log_partition_function(subseq, md, mfe, 1 - h)
+    (lnZ_hi, kT_hi) = log_partition_function(subseq, md, mfe, 1 + h)
+    lnZ  = [lnZ_lo, lnZ, lnZ_hi]
+    beta = [1 / kT_lo, 1 / kT, 1 / kT_hi]
+
+    d_lo = (lnZ[1] - lnZ[0]) / (beta[1] - beta[0])
+    d_hi = (lnZ[2] - lnZ[1]) / (beta[2] - beta[1])
+    mean = -(lnZ[2] - lnZ[0]) / (beta[2] - beta[0])
+    var  = 2 * (d_hi - d_lo) / (beta[2] - beta[0])
+    return mean, max(var, 0.)
+
+
+def energy_density_of_states(fc, delta):
+    """
+    Return the distinct free energies (in ascending order) of all structures
+    of fold compound fc within delta kcal/mol above the MFE, together with
+    the number of structures per energy
+    """
+    dos     = Counter()
+
+    def count(structure, energy, data):
+        if structure:
+            dos[energy] += 1
+
+    # structures are passed to the callback, i.e. they are never stored
+    fc.subopt_cb(int(round(delta * 100)), count, None)
+    energies = np.array(sorted(dos))
+    return energies, np.array([dos[e] for e in energies])
+
+
+def exact_energies(subseq, md, band):
+    """
+    Return the MFE and the Q25, Q75, median, mean, min, max free energy and the
+    standard deviation of the free energy of the Boltzmann ensemble of subseq.
+    Mean, standard deviation and MFE (= min) are exact. The
+    quantiles are the exact inverse of the cumulative Boltzmann distribution
+    obtained from the density of states up to at most band kcal/mol above the
+    MFE, quantiles beyond that band (and the max) are NaN.
+    """
+    fc        = RNA.fold_compound(subseq, md)
+    (ss, mfe) = fc.mfe()
+    lnZ, kT   = log_partition_function(subseq, md, mfe, fc = fc)
+    mean, var = energy_moments(subseq, md, mfe, lnZ, kT)
+
+    q = np.array([0.25, 0.75, 0.5])
+    # The energy band that covers the 75% quantile of a normal distribution
+    # with the same moments, widened by one standard deviation until the
+    # density of states covers the quantiles or exceeds the maximum band
+    sd    = np.sqrt(var)
+    delta = min(band, max(mean + 0.6745 * sd - mfe, 0.) + 0.1)
+    while True:
+        energies, counts = energy_density_of_states(fc, delta)
+        # Boltzmann probabilities of all structures with a given energy
+        cdf = np.cumsum(counts * np.exp(-energies / kT - lnZ))
+        if cdf[-1] >= q.max() or delta >= band:
+            break
+        delta = min(band, delta + max(sd, 0.5))
+
+    k = np.searchsorted(cdf, q)
+    quantiles = np.where(k < len(energies), energies[np.minimum(k, len(energies) - 1)], np.nan)
+    return mfe, np.concatenate([quantiles, [mean, mfe, np.nan, sd]])
+
+
+def sample_energies(fc, subseq, samples):
+    """
+    Draw Boltzmann samples of the nascent transcript subseq from fold compound
+    fc (which may also belong to an extended sequence) and return the free
+    energies of all distinct structures together with their multiplicities
+    """
+    structures = Counter(fc.pbacktrack5(samples, len(subseq)))
+    # evaluate every distinct structure only once
+    energies = [ RNA.eval_structure_simple(subseq, s) for s in structures ]
+    return np.array(energies), np.array(list(structures.values()))
+
+
+def format_energy_lines(args, i, energies, counts, mfe, method = "sampling"):
+    """
+    Return the energy distribution lines for sampled energies with
+    multiplicities counts (and the MFE if requested) of the nascent
+    transcript of length i. If counts is None, energies are the Q25,
+    Q75, median, mean, min and max energy (and optionally the standard
+    deviation) already.
+    """
+    # Q25, Q75, median, mean, min and max of the sampled energies
+    if counts is None:
+        stats = energies
+    else:
+        stats = weighted_stats(np.zeros(len(energies)), energies, counts)[0]
+
+    # result for sampling (or exact) approach
+    line = [str(i), method, args.sequence_id]
+    line += ["{:.2f}".format(d) if not np.isnan(d) else "NA" for d in stats]
+    lines = [",".join(line)]
+
+    if args.mfe:
+        line = [str(i), "MFE", args.sequence_id]
+        line += ["{:.2f}".format(d) for d in [mfe for i in range(6)] ]
+        line += ["NA" for d in stats[6:]]
+        lines.append(",".join(line))
+
+    return lines
 
-        line = [str(l), args.sequence_id, "{:g}".format(fc.mean_bp_distance()/l)]
-        # print ensemble diversity
-        print(",".join(line), file=outfile)
 
-    if outfile != sys.stdout:
-        outfile.close()
+ENERGY_HEADER = ["length",
+                 "method",
+                 "name",
+                 "Q25",
+                 "Q75",
+                 "Qmedian",
+                 "Qmean",
+                 "Qmin",
+                 "Qmax"]
 
 
 def fold_and_print(args, sequence, outfile):
@@ -143,69 +668,397 @@ def fold_and_print(args, sequence, outfile):
     Compute MFE and obtain Boltzmann samples from all nascent transcript lengths.
     Additionally, guide structure prediction by SHAPE data if available.
     """
-    SHAPE_data = None
-    f_div = None
-
-    if args.SHAPE:
-        SHAPE_data = get_SHAPE_data(args.SHAPE, n, args.offset)
+    n = len(sequence)
+    # computed once, before the worker processes are started
+    get_SHAPE_energies(args, n, sequence)
+    if not args.exact and not args.SHAPE:
+        md          = RNA.md()
+        md.uniq_ML  = 1
+        get_full_fc(sequence, md)
 
     if args.header:
-        header = ["length",
-                  "method",
-                  "name",
-                  "Q25",
-                  "Q75",
-                  "Qmedian",
-                  "Qmean",
-                  "Qmin",
-                  "Qmax"]
-
-        print(",".join(header), file=outfile)
+        # the exact mode adds the standard deviation of the energy
+        print(",".join(ENERGY_HEADER + (["Qsd"] if args.exact else [])), file=outfile)
+
+    for lines in map_lengths(energy_lines, args, range(args.start, n + 1), sequence):
+        print("\n".join(lines), file=outfile)
+
 
+def all_lines(args, l, sequence):
+    """
+    Compute accessibilities, ensemble diversity, sampled energies and the MFE
+    of the nascent transcript of length l from a single partition function
+    """
     md          = RNA.md()
     md.uniq_ML  = 1
 
-    n       = len(sequence)
-    fc      = RNA.fold_compound(sequence, md)
-    ss, mfe = fc.mfe()
+    subseq = sequence[0:l]
+    if l >= args.start:
+        # the fold compound is required for sampling
+        folded = fold_prefix(subseq, md)
+        props  = prefix_ensemble(args, subseq, md, folded)
+    else:
+        props  = prefix_ensemble(args, subseq, md)
 
-    fc.exp_params_rescale(mfe)
-    fc.pf()
+    # accessibilities
+    line_list = [str(l), "equilibrium", args.sequence_id]
+    line_list += [ "{:g}".format(p) for p in props["unpaired"].tolist() ]
+    line_list += [ "NA" for i in range(l + 1, len(sequence) + 1) ]
+    access_line = ",".join(line_list)
+
+    # ensemble diversity
+    div_line = ",".join([str(l), args.sequence_id, "{:g}".format(props["mbpd"]/l)])
+
+    # sampled energies and MFE
+    en_lines = []
+    if l >= args.start:
+        energies, counts = sample_energies(folded[0], subseq, args.samples)
+        en_lines = format_energy_lines(args, l, energies, counts, folded[1])
+
+    return access_line, div_line, en_lines
+
+
+def predict_all(args, sequence, outfiles):
+    """
+    Predict accessibility profiles, ensemble diversity profiles and
+    energy distributions, folding every nascent transcript only once
+    """
+    f_up, f_div, f_en = outfiles
+    n = len(sequence)
+
+    # print header lines
+    if args.header:
+        head_list = ["length", "method", "name"]
+        head_list += [str(i) for i in range(1, n + 1) ]
+        print(",".join(head_list), file=f_up)
+        print(",".join(["length", "name", "div"]), file=f_div)
+        print(",".join(ENERGY_HEADER), file=f_en)
+
+    for (access_line, div_line, en_lines) in map_lengths(all_lines, args, range(1, n + 1), sequence):
+        print(access_line, file=f_up)
+        print(div_line, file=f_div)
+        for line in en_lines:
+            print(line, file=f_en)
+
+
+def rank_rows(X):
+    """
+    Return the ranks (1, 2, ...) of the values in every row of matrix X,
+    where ties get their average rank. NaN values are not ranked.
+    """
+    X     = np.asarray(X, dtype = np.float64)
+    order = np.argsort(X, axis = 1) # NaN values are sorted last
+    S     = np.take_along_axis(X, order, axis = 1)
+    j     = np.broadcast_to(np.arange(X.shape[1]), X.shape)
+    # first and last index of every group of equal values in the sorted rows
+    new   = np.ones(X.shape, dtype = bool)
+    new[:, 1:] = S[:, 1:] != S[:, :-1]
+    end   = np.ones(X.shape, dtype = bool)
+    end[:, :-1] = new[:, 1:]
+    first = np.maximum.accumulate(np.where(new, j, 0), axis = 1)
+    last  = np.minimum.accumulate(np.where(end, j, X.shape[1])[:, ::-1], axis = 1)[:, ::-1]
+    ranks = np.empty(X.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis = 1)
+    ranks[np.isnan(X)] = np.nan
+    return ranks
+
+
+def agreement_scores(unpaired, reactivities, threshold = None):
+    """
+    Compare predicted probabilities to be unpaired with SHAPE reactivities,
+    given as (lengths x positions) matrices with NaN for missing data.
+    Return the Spearman rank correlation and the ROC AUC of every row, where
+    nucleotides with a reactivity above threshold (defaults to the median of
+    the row) are considered unpaired. Rows with too little data are NaN.
+    """
+    valid = ~np.isnan(unpaired) & ~np.isnan(reactivities)
+    U     = np.where(valid, unpaired, np.nan)
+    R     = np.where(valid, reactivities, np.nan)
+    count = valid.sum(axis = 1)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        # Pearson correlation of the ranks
+        rU  = rank_rows(U)
+        rR  = rank_rows(R)
+        dU  = np.where(valid, rU - (count[:, None] + 1) / 2, 0)
+        dR  = np.where(valid, rR - (count[:, None] + 1) / 2, 0)
+        rho = (dU * dR).sum(axis = 1) / np.sqrt((dU ** 2).sum(axis = 1) * (dR ** 2).sum(axis = 1))
+
+        # Mann-Whitney U statistic of the unpaired probabilities
+        if threshold is None:
+            threshold = np.full((len(R), 1), np.nan)
+            rows = count > 0
+            threshold[rows] = np.nanmedian(R[rows], axis = 1, keepdims = True)
+        pos = valid & (R > threshold)
+        npos = pos.sum(axis = 1)
+        nneg = count - npos
+        auc = (np.where(pos, rU, 0).sum(axis = 1) - npos * (npos + 1) / 2) / (npos * nneg)
+
+    rho[count < 3] = np.nan
+    auc[(npos == 0) | (nneg == 0)] = np.nan
+    return rho, auc
 
-    for i in range(args.start, n + 1):
-        energies  = []
-        subseq    = sequence[0 : i]
-        (ss, mfe) = RNA.fold(subseq)
-
-        if SHAPE_data:
-            fc_sub = RNA.fold_compound(subseq, md)
-            if i < len(SHAPE_data):
-                fc_sub.sc_add_SHAPE_deigan(SHAPE_data[i], 1.1, -0.3)
-            fc_sub.exp_params_rescale(mfe)
-            fc_sub.pf()
+
+def sweep_accessibility(args, l, sequence):
+    """
+    Return the probabilities to be unpaired of the nascent transcript of
+    length l for the energy model and SHAPE parameters of args
+    """
+    set_energy_model(args.params, args.temperature)
+    sc = get_SHAPE_constraints(args, l, sequence)
+    return prefix_ensemble(args, sequence[0:l], sc = sc)["unpaired"]
+
+
+def sweep(args, sequence, outfile):
+    """
+    Predict accessibility profiles for a grid of SHAPE pseudo-energy
+    parameters, temperatures and energy parameter files, and rank the grid
+    points by the agreement with the reference reactivities. Nascent
+    transcripts that are folded with identical energy model and soft
+    constraints (e.g. lengths without SHAPE data) are only folded once.
+    """
+    n         = len(sequence)
+    reference = get_SHAPE_data(args.reference or args.SHAPE, n, args.offset,
+                               args.SHAPE_method, sequence)
+    lengths   = [ l for l in range(args.start, min(n, len(reference) - 1) + 1)
+                    if (reference[l, 1:l + 1] > -999).any() ]
+    R = reference[lengths, 1:n + 1]
+    R = np.where(R > -999, R, np.nan)
+    get_SHAPE_energies(args, n, sequence)
+
+    slopes     = args.slopes if args.slopes else [args.SHAPE_slope]
+    intercepts = args.intercepts if args.intercepts else [args.SHAPE_intercept]
+    temps      = args.temperatures if args.temperatures else [args.temperature]
+    params     = [ None if p == "default" else p for p in args.param_files ] \
+                    if args.param_files else [args.params]
+
+    points = []
+    for (m, b, temp, par) in product(slopes, intercepts, temps, params):
+        pargs = argparse.Namespace(**vars(args))
+        pargs.SHAPE_slope, pargs.SHAPE_intercept = m, b
+        pargs.temperature, pargs.params = temp, par
+        pargs.params_digest = file_digest(par)
+        points.append(pargs)
+
+    # unique folding tasks, grouped by energy model (parameter files are
+    # loaded once per group) and the largest lengths first
+    tasks = {}
+    for pargs in points:
+        for l in lengths:
+            sc  = get_SHAPE_constraints(pargs, l, sequence)
+            key = (l, pargs.params_digest, pargs.temperature, array_digest(sc))
+            tasks.setdefault(key, pargs)
+    order = sorted(tasks, key = lambda key: (key[1] or "", key[2], -key[0]))
+
+    jobs = pool_size(args.jobs, len(order))
+    if jobs == 1:
+        results = { key : sweep_accessibility(tasks[key], key[0], sequence) for key in order }
+    else:
+        with Pool(processes = jobs,
+                  initializer = init_worker,
+                  initargs = (args.params, args.temperature)) as pool:
+            results = { key : pool.apply_async(sweep_accessibility, (tasks[key], key[0], sequence))
+                            for key in order }
+            results = { key : r.get() for key, r in results.items() }
+
+    table = []
+    for pargs in points:
+        U = np.full((len(lengths), n), np.nan)
+        for k, l in enumerate(lengths):
+            sc  = get_SHAPE_constraints(pargs, l, sequence)
+            U[k, :l] = results[(l, pargs.params_digest, pargs.temperature, array_digest(sc))]
+        rho, auc = agreement_scores(U, R, args.threshold)
+        with np.errstate(invalid = "ignore"):
+            scores = { "spearman" : np.nanmean(rho) if len(rho) else np.nan,
+                       "auc"      : np.nanmean(auc) if len(auc) else np.nan }
+        table.append((pargs, scores, int((~np.isnan(rho)).sum())))
+
+    # best agreement first, NaN scores last
+    table.sort(key = lambda row: -row[1][args.score] if not np.isnan(row[1][args.score]) else np.inf)
+
+    if args.header:
+        print(",".join(["rank", "name", "slope", "intercept", "temperature", "params",
+                        "spearman", "auc", "lengths"]), file=outfile)
+    fmt = lambda v: "{:g}".format(v) if not np.isnan(v) else "NA"
+    for r, (pargs, scores, count) in enumerate(table, 1):
+        line_list = [str(r), args.sequence_id]
+        line_list += [ fmt(pargs.SHAPE_slope), fmt(pargs.SHAPE_intercept) ] if args.SHAPE else ["NA", "NA"]
+        line_list += [ fmt(pargs.temperature), pargs.params if pargs.params else "default" ]
+        line_list += [ fmt(scores["spearman"]), fmt(scores["auc"]), str(count) ]
+        print(",".join(line_list), file=outfile)
+
+
+def open_outputs(args, name, fmode):
+    """
+    Open the output file(s) of the prediction mode, where name is used as
+    prefix for the output files of the 'all' mode
+    """
+    if args.func is predict_all:
+        return tuple(open(f"{name}.{metric}.csv", fmode)
+                        for metric in ("accessibility", "diversity", "energy"))
+    return open(name, fmode)
+
+
+def close_outputs(outfile):
+    for f in (outfile if isinstance(outfile, tuple) else (outfile,)):
+        if f != sys.stdout:
+            f.close()
+
+
+def record_fingerprint(args, sequence):
+    """
+    Return a hash of a sequence and all options that affect its predictions
+    """
+    # input files are represented by the digest of their content
+    options = { k : v for k, v in sorted(vars(args).items())
+                    if k in ("params_digest", "temperature", "samples", "mfe", "start", "SHAPE_digest",
+                             "offset", "SHAPE_method", "SHAPE_slope", "SHAPE_intercept",
+                             "exact", "band", "window", "max_span", "reference_digest", "slopes",
+                             "intercepts", "temperatures", "param_files_digest", "threshold", "score") }
+    key = json.dumps([args.func.__name__, sequence, options])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def predict_record(args, sequence, seq_id, header):
+    """
+    Run the prediction mode for one record of a batch, return the output as string(s)
+    """
+    rargs = argparse.Namespace(**vars(args))
+    rargs.sequence_id = seq_id
+    rargs.header = header
+    rargs.jobs = 1
+    nout = 3 if args.func is predict_all else 1
+    buffers = tuple(io.StringIO() for _ in range(nout))
+    args.func(rargs, sequence, buffers if nout > 1 else buffers[0])
+    return tuple(b.getvalue() for b in buffers)
+
+
+def batch(args):
+    """
+    Predict all records of a multi-FASTA file (or directory of FASTA files).
+    Records are distributed to a pool of worker processes and their output
+    is written in input order, either into one file (-o/-a) or into one file
+    per record (--outdir), keyed by the record id (duplicate ids are
+    rejected). Records that are already found in the output, with
+    identical sequence and options, are skipped. Records that changed
+    since they were appended to an output file (-a) are rejected, they
+    cannot be replaced in the file.
+    """
+    records = []
+    for k, (sequence, seq_id) in enumerate(get_sequences(args.input), 1):
+        seq_id = seq_id if seq_id else f"{args.sequence_id or 'RNA'}_{k}"
+        records.append((sequence, seq_id))
+
+    # outputs and manifest entries are keyed by the record id
+    ids = Counter(seq_id for (sequence, seq_id) in records)
+    duplicates = [ seq_id for seq_id, count in ids.items() if count > 1 ]
+    if duplicates:
+        print(f"Duplicate record ids {', '.join(duplicates)} in {args.input}. " +
+              "Every record needs a unique id.", file=sys.stderr)
+        exit(1)
+
+    # the manifest records the fingerprints of all records in the output
+    manifest, mfile = {}, None
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok = True)
+        mfile = os.path.join(args.outdir, "manifest.json")
+    elif args.output or args.append_to:
+        mfile = f"{args.output or args.append_to}.manifest.json"
+    if mfile and os.path.exists(mfile) and not args.output:
+        with open(mfile) as mf:
+            manifest = json.load(mf)
+
+    todo, changed = [], []
+    for (sequence, seq_id) in records:
+        fp = record_fingerprint(args, sequence)
+        if manifest.get(seq_id) == fp:
+            print(f"Skipping unchanged record {seq_id}", file=sys.stderr)
+            continue
+        if seq_id in manifest and args.append_to:
+            changed.append(seq_id)
+        todo.append((sequence, seq_id, fp))
+
+    if changed:
+        print(f"Records {', '.join(changed)} (or the options) changed since they were appended " +
+              f"to {args.append_to}. Use -o/--output or --outdir to recompute the output.",
+              file=sys.stderr)
+        exit(1)
+
+    outfile = None
+    if not args.outdir:
+        if args.output:
+            outfile = open_outputs(args, args.output, "w")
+        elif args.append_to:
+            outfile = open_outputs(args, args.append_to, "a")
         else:
-            fc_sub = fc
+            outfile = sys.stdout
+        outfile = outfile if isinstance(outfile, tuple) else (outfile,)
 
-        for s in fc_sub.pbacktrack5(args.samples, i):
-            energies.append(RNA.eval_structure_simple(subseq, s))
+    # one header per output file
+    tasks = [ (args, sequence, seq_id, args.header if args.outdir else (args.header and e == 0))
+                for e, (sequence, seq_id, fp) in enumerate(todo) ]
 
-        df  = pd.Series(energies)
-        qt  = df.quantile([0.25,0.75])
+    jobs = pool_size(args.jobs, len(tasks))
+    if jobs == 1:
+        results = (predict_record(*task) for task in tasks)
+    else:
+        pool = Pool(processes = jobs,
+                    initializer = init_worker,
+                    initargs = (args.params, args.temperature))
+        results = (r.get() for r in [ pool.apply_async(predict_record, task) for task in tasks ])
 
-        # print result for sampling approach
-        line = [str(i), "sampling", args.sequence_id]
-        line += ["{:.2f}".format(d) for d in [ qt[0.25],
-                                                qt[0.75],
-                                                df.median(),
-                                                df.mean(),
-                                                df.min(),
-                                                df.max() ] ]
-        print(",".join(line), file=outfile)
+    for (sequence, seq_id, fp), texts in zip(todo, results):
+        if args.outdir:
+            rfile = open_outputs(args, os.path.join(args.outdir, f"{seq_id}" if
+                                    args.func is predict_all else f"{seq_id}.csv"), "w")
+            rfile = rfile if isinstance(rfile, tuple) else (rfile,)
+        else:
+            rfile = outfile
+        for f, text in zip(rfile, texts):
+            f.write(text)
+            f.flush()
+        if args.outdir:
+            close_outputs(rfile)
+        manifest[seq_id] = fp
+        if mfile:
+            with open(mfile, "w") as mf:
+                json.dump(manifest, mf, indent = 1)
 
-        if args.mfe:
-            line = [str(i), "MFE", args.sequence_id]
-            line += ["{:.2f}".format(d) for d in [mfe for i in range(6)] ]
-            print(",".join(line), file=outfile)
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    if outfile:
+        close_outputs(outfile)
+
+
+def predict(args):
+    """
+    Predict a single sequence
+    """
+    # read input sequence
+    sequence, seq_id  = get_sequence_line(args.input)
+
+    # exit script if no sequence is available
+    if not sequence:
+        print(f'Unable to parse any sequence data from file {args.input}')
+        exit(1)
+
+    # prepare output stream
+    if args.output:
+        outfile = open_outputs(args, args.output, "w")
+    elif args.append_to:
+        outfile = open_outputs(args, args.append_to, "a")
+    else:
+        outfile = sys.stdout
+
+    # prepare sequence identifier
+    if not args.sequence_id:
+        args.sequence_id = seq_id if seq_id else "RNA"
+
+    # call prediction mode function
+    args.func(args, sequence, outfile)
+
+    close_outputs(outfile)
 
                     
 def main():
@@ -243,14 +1096,76 @@ def main():
     parser.add_argument("-P", "--params",
                         type = str,
                         help = "Load a different energy parameter set.")
+    parser.add_argument("-T", "--temperature",
+                        type = float,
+                        help = "Folding temperature in degrees Celsius.",
+                        default = 37.0)
+    parser.add_argument("--cache",
+                        type = str,
+                        help = """Directory of a persistent cache for MFE, ensemble energy,
+                        accessibilities and ensemble diversity of nascent transcripts.""")
+    parser.add_argument("--cache-size",
+                        type = int,
+                        help = "Size limit of the cache in MB. Least recently used entries are removed.",
+                        default = 1024)
+    parser.add_argument("--window",
+                        type = int,
+                        help = """Accessibility and diversity: local folding with this window
+                        size (plfold-style), only the last nucleotides of each nascent
+                        transcript are re-computed.""")
+    parser.add_argument("--max-span",
+                        type = int,
+                        help = "Local folding: maximal base pair span. Defaults to the window size.")
+    parser.add_argument("-b", "--batch",
+                        action = "store_true",
+                        help = """Predict all records of a multi-FASTA input file, or of all FASTA
+                        files in an input directory. With -j/--jobs, records are distributed
+                        to the worker processes.""")
+    parser.add_argument("--outdir",
+                        type = str,
+                        help = "Batch mode: write one output file per record into this directory.")
+    parser.add_argument("-j", "--jobs",
+                        type = int,
+                        help = """Number of worker processes to fold the nascent transcripts in parallel
+                        (0 = all cpus, at most one per cpu).""",
+                        default = 1)
 
     # create sub-parsers for the different modes of this script
     sub_parsers = parser.add_subparsers(title = 'subcommands',
                                         description = 'valid sub-commands',
                                         required = True)
 
+    # SHAPE options of the energy, accessibility and diversity modes
+    shape_parser = argparse.ArgumentParser(add_help = False)
+    shape_parser.add_argument("--SHAPE",
+                          type = str,
+                          help = """cotranscriptional SHAPE reactivity file (RDAT, *.npz or
+                          csv formatted).""")
+    shape_parser.add_argument("--SHAPE-method",
+                          type = str,
+                          help = """Use the rows of this method (2nd column) from a SHAPE file with
+                          length,method,name header, e.g. SHAPE-weighted for the output of
+                          merge_replicates.py, or this matrix of a *.npz file (e.g. weighted).
+                          Defaults to the first method in the file.""",
+                          default = None)
+    shape_parser.add_argument("--offset",
+                           type = int,
+                           help = """Use the SHAPE data of transcript length l + offset
+                           for the nascent transcript of length l (nucleotides bound
+                           by the polymerase).""",
+                           default = 14)
+    shape_parser.add_argument("--SHAPE-slope",
+                          type = float,
+                          help = "Slope m of the SHAPE pseudo-energies m * ln(r + 1) + b (in kcal/mol).",
+                          default = 1.1)
+    shape_parser.add_argument("--SHAPE-intercept",
+                          type = float,
+                          help = "Intercept b of the SHAPE pseudo-energies m * ln(r + 1) + b (in kcal/mol).",
+                          default = -0.3)
+
     # options for the 'energy distribution' mode
     parser_en = sub_parsers.add_parser('energy',
+                                       parents = [shape_parser],
                                        help='Energy distribution help')
     parser_en.add_argument("-n", "--samples",
                            type = int,
@@ -259,69 +1174,146 @@ def main():
     parser_en.add_argument("--mfe",
                            action = "store_true",
                            help = "Add MFE values.")
-    parser_en.add_argument("--SHAPE",
-                          type = str,
-                          help = "cotranscriptional SHAPE reactivity file (csv formatted).")
     parser_en.add_argument("--start",
                            type = int,
                            help = "Start length",
                            default = 15)
-    parser_en.add_argument("--offset",
-                           type = int,
-                           help = "Offset of SHAPE data",
-                           default = 14)
+    parser_en.add_argument("--exact",
+                           action = "store_true",
+                           help = """Compute the exact mean free energy from the partition function
+                           and the quantiles from the density of states (instead of sampling).
+                           Adds the standard deviation of the free energy as column Qsd.""")
+    parser_en.add_argument("--band",
+                           type = float,
+                           help = """Exact mode: maximum energy band above the MFE (in kcal/mol)
+                           for the density of states. Quantiles beyond this band are NA.""",
+                           default = 10.)
     parser_en.set_defaults(func = fold_and_print)
 
     # options for the 'accessibility profile' mode
     parser_up = sub_parsers.add_parser('accessibility',
+                                       parents = [shape_parser],
                                        help = 'Accessibility profile help')
-    # no further options for this mode (yet)
+    # only the SHAPE options for this mode (yet)
     parser_up.set_defaults(func = accessibility)
 
 
     # options for the 'ensemble diversity' mode
     parser_div = sub_parsers.add_parser('diversity',
+                                        parents = [shape_parser],
                                         help = 'Ensemble diversity profile help')
 
-    # no further options for this mode (yet)
+    # only the SHAPE options for this mode (yet)
     parser_div.set_defaults(func = diversity)
 
-    parser.add_argument('input', default=None, help="Path to the input file.")
+    # options for the combined mode
+    parser_all = sub_parsers.add_parser('all',
+                                        help = """Accessibility, ensemble diversity and energy
+                                        distribution from a single partition function per
+                                        transcript length. Requires -o/-a, which is used as
+                                        prefix for the output files <prefix>.accessibility.csv,
+                                        <prefix>.diversity.csv and <prefix>.energy.csv""")
+    parser_all.add_argument("-n", "--samples",
+                           type = int,
+                           help = "Number of samples per subsequence.",
+                           default = 1000)
+    parser_all.add_argument("--mfe",
+                           action = "store_true",
+                           help = "Add MFE values.")
+    parser_all.add_argument("--start",
+                           type = int,
+                           help = "Start length of the energy distribution",
+                           default = 15)
+    parser_all.set_defaults(func = predict_all)
 
-    args = parser.parse_args()
+    # options for the parameter sweep
+    parser_sw = sub_parsers.add_parser('sweep',
+                                       parents = [shape_parser],
+                                       help = """Rank a grid of SHAPE pseudo-energy parameters,
+                                       temperatures and energy parameter files by the agreement
+                                       of the predicted accessibilities with SHAPE reactivities""")
+    parser_sw.add_argument("--reference",
+                           type = str,
+                           help = """SHAPE reactivity file (RDAT, *.npz or csv formatted) to score
+                           the predictions. Defaults to the --SHAPE file, use e.g. a different
+                           replicate to avoid scoring the data that guides the prediction.
+                           The --offset applies as well.""")
+    parser_sw.add_argument("--slopes",
+                           type = float,
+                           nargs = "+",
+                           help = "Grid of --SHAPE-slope values.")
+    parser_sw.add_argument("--intercepts",
+                           type = float,
+                           nargs = "+",
+                           help = "Grid of --SHAPE-intercept values.")
+    parser_sw.add_argument("--temperatures",
+                           type = float,
+                           nargs = "+",
+                           help = "Grid of temperatures.")
+    parser_sw.add_argument("--param-files",
+                           type = str,
+                           nargs = "+",
+                           help = "Grid of energy parameter files, 'default' for the default parameters.")
+    parser_sw.add_argument("--start",
+                           type = int,
+                           help = "Start length of the scored transcripts",
+                           default = 15)
+    parser_sw.add_argument("--threshold",
+                           type = float,
+                           help = """AUC: nucleotides with higher reactivity are considered unpaired.
+                           Defaults to the median reactivity of each transcript.""")
+    parser_sw.add_argument("--score",
+                           choices = ["spearman", "auc"],
+                           help = """Rank the grid points by the mean Spearman correlation or the
+                           mean ROC AUC over all transcript lengths.""",
+                           default = "spearman")
+    parser_sw.set_defaults(func = sweep)
 
-    # read input sequence
-    sequence, seq_id  = get_sequence_line(args.input)
-    n                 = len(sequence)
+    parser.add_argument('input', default=None, help="Path to the input file.")
 
-    # exit script if no sequence is available
-    if not sequence:
-        print(f'Unable to parse any sequence data from file {args.input}')
-        exit(1)
+    args = parser.parse_args()
 
-    # prepare output stream
-    if args.output:
-        outfile = open(args.output, "w")
-        if not args.no_header:
-            args.header = True
-    elif args.append_to:
-        outfile = open(args.append_to, "a")
+    if args.func is predict_all and not (args.output or args.append_to or
+                                         (args.batch and args.outdir)):
+        parser.error("Subcommand 'all' requires -o/--output or -a/--append-to.")
+    if args.outdir and not args.batch:
+        parser.error("Option --outdir requires -b/--batch.")
+    if args.window or args.max_span:
+        args.window   = args.window or args.max_span
+        args.max_span = args.max_span or args.window
+        if args.func not in (accessibility, diversity):
+            parser.error("Options --window/--max-span are only available for accessibility and diversity.")
+        if args.max_span > args.window:
+            parser.error("Option --max-span must not exceed the --window size.")
+    if args.window and getattr(args, "SHAPE", None):
+        parser.error("Options --window/--max-span cannot be combined with --SHAPE.")
+    if args.func is sweep and not (args.SHAPE or args.reference):
+        parser.error("Subcommand 'sweep' requires --SHAPE or --reference.")
+    if args.func is sweep and not args.SHAPE and (args.slopes or args.intercepts):
+        parser.error("Options --slopes/--intercepts require --SHAPE.")
+    if getattr(args, "exact", False) and args.SHAPE:
+        parser.error("Option --exact cannot be combined with --SHAPE.")
 
-    if not outfile:
-        if not args.no_header:
-            args.header = True
-        outfile = sys.stdout
+    # add header lines unless appending to an existing file
+    if not args.append_to and not args.no_header:
+        args.header = True
 
     # load energy parameters if necessary
-    if args.params:
-        RNA.read_parameter_file(args.params)
+    set_energy_model(args.params, args.temperature)
+    args.params_digest = file_digest(args.params)
+    args.SHAPE_digest = file_digest(getattr(args, "SHAPE", None))
+    args.reference_digest = file_digest(getattr(args, "reference", None))
+    args.param_files_digest = [ file_digest(p) if p != "default" else None
+                                    for p in getattr(args, "param_files", None) or [] ]
 
-    # prepare sequence identifier
-    if not args.sequence_id:
-        args.sequence_id = seq_id if seq_id else "RNA"
+    if args.batch:
+        batch(args)
+    else:
+        predict(args)
 
-    # call prediction mode function
-    args.func(args, sequence, outfile)
+    # limit the size of the cache
+    if args.cache:
+        get_cache(args).evict()
 
 
 if __name__ == '__main__':
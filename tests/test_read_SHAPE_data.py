@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "drconverters"))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+from drconverters.rdat import RdatFile
+from thermo_predict import read_SHAPE_data
+
+RDAT = os.path.join(ROOT, "SHAPE", "SRPECLI_BZCN_0001.rdat")
+
+
+def write_legacy_csv(rdat, filename):
+    """Write the reactivities as csv rows with the length followed by values."""
+    with open(filename, "w") as f:
+        print("length,values", file = f)
+        for l, values in rdat.rows("REACTIVITY"):
+            print(",".join([str(l)] + [ "NA" if np.isnan(v) else repr(float(v))
+                                            for v in values[:l] ]), file = f)
+
+
+def test_legacy_csv_matches_rdat(tmp_path):
+    rdat = RdatFile(RDAT)
+    n = len(rdat.sequence)
+    legacy = str(tmp_path / "legacy.csv")
+    write_legacy_csv(rdat, legacy)
+    for offset in (0, 14):
+        expected = read_SHAPE_data(RDAT, n, offset)
+        assert np.array_equal(read_SHAPE_data(legacy, n, offset), expected)
+
+
+def test_offset_shifts_transcript_length():
+    rdat = RdatFile(RDAT)
+    n = len(rdat.sequence)
+    data = read_SHAPE_data(RDAT, n, 14)
+    row = rdat.row(74)[:60]
+    assert np.array_equal(data[60, 1:61], np.where(np.isnan(row), -999., row))